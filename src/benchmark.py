@@ -0,0 +1,237 @@
+# Headless benchmark of every generation stage
+# Times control point generation, getCurvePoints, thickenHemline, the make* builder, makeSTL and mesh
+# verification for every mesh type over a sweep of fold counts and resolutions. Results are written as JSON,
+# comparing against an earlier result file fails (exit code 1) when a stage got slower than the threshold
+# --decimate adds a comparison of decimated meshes (maxFaces) against the undecimated ones: face count,
+# file sizes and Hausdorff error
+#
+#   python benchmark.py --output bench.json
+#   python benchmark.py --baseline bench.json --threshold 0.25
+#   python benchmark.py --quick --decimate
+import argparse, json, os, platform, subprocess, sys, tempfile, time
+import numpy as np
+import trimesh
+
+from hemline_bspline import getCurvePoints, getSampleParams
+from hemline_thickness import thickenHemline
+from create_mesh import makeCurtain, makeCurtainFullCircle, makeCape, makeSkirt, makeSTL, isValidMesh, getSTLBytes, \
+    getCompactBytes, getImpliedTopology, getSegmentSquaredDistances, CLOSED_MESH_TYPES
+from helper import GenerationEngine, TOP_RADIUS_RATIO, TOP_THICKNESS_RATIO, CLOSED_HEMLINE_TYPES
+
+MESH_TYPES = ('curtain', 'tube', 'cape', 'skirt')
+FOLD_COUNTS = (1, 5, 20, 50, 100)
+RESOLUTIONS = (0.01, 0.001, 0.0001)
+# Smaller sweep for a quick check
+QUICK_FOLD_COUNTS = (1, 20)
+QUICK_RESOLUTIONS = (0.01, 0.001)
+
+# Fold parameters of the full size skirt (see helper.generateSkirt)
+FOLD_PARAMS = (6, 8, 4, 5, 1, 3)
+RADIUS = 20
+THICKNESS = 0.5
+HEIGHT = 35
+RANDOM_SEED = 1
+
+# Face budgets of the decimation comparison, as fractions of the undecimated face count
+DECIMATION_BUDGETS = (0.5, 0.25, 0.1, 0.05)
+DECIMATION_FOLD_COUNTS = (5, 20)
+DECIMATION_RESOLUTIONS = (0.001, 0.0001)
+
+STAGES = ('controlPoints', 'getCurvePoints', 'thickenHemline', 'make', 'makeSTL', 'isValidMesh', 'trimeshVerify')
+
+# Best time of repeats calls of func, the result of the last call is returned with it
+def timeCall(func, repeats):
+    best = float('inf')
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+# Time every stage of one mesh, the stage caches are bypassed so every stage really runs
+def benchmarkCase(meshType, numFolds, resolution, repeats, outputDir):
+    engine = GenerationEngine(RANDOM_SEED, stageCaches = None)
+    radii = [RADIUS] + ([RADIUS * TOP_RADIUS_RATIO[meshType]] if meshType in TOP_RADIUS_RATIO else [])
+    closed = meshType in CLOSED_HEMLINE_TYPES
+    timings = {}
+
+    timings['controlPoints'], ctrlPointSets = timeCall(lambda: [engine.getControlPoints(meshType, numFolds, *FOLD_PARAMS, \
+                                                                radius, False) for radius in radii], repeats)
+
+    def evaluateCurves():
+        sampleParams = getSampleParams(ctrlPointSets, resolution = resolution)
+        return [getCurvePoints(ctrlPoints, resolution = resolution, params = sampleParams) for ctrlPoints in ctrlPointSets]
+    timings['getCurvePoints'], hemlines = timeCall(evaluateCurves, repeats)
+
+    thicknesses = (THICKNESS, THICKNESS * TOP_THICKNESS_RATIO)
+    timings['thickenHemline'], thickHemlines = timeCall(lambda: [thickenHemline(hemline, thickness = thickness, closed = closed) \
+                                                                 for hemline, thickness in zip(hemlines, thicknesses)], repeats)
+
+    def make():
+        if meshType == 'curtain':
+            return makeCurtain(*thickHemlines[0], height = HEIGHT)
+        if meshType == 'tube':
+            return makeCurtainFullCircle(*thickHemlines[0], height = HEIGHT)
+        makeMesh = makeSkirt if meshType == 'skirt' else makeCape
+        return makeMesh(*thickHemlines[0], *thickHemlines[1], height = HEIGHT)
+    timings['make'], (vertices, faces) = timeCall(make, repeats)
+
+    filename = '{}_{}_{}.stl'.format(meshType, numFolds, resolution)
+    timings['makeSTL'], _ = timeCall(lambda: makeSTL(vertices, faces, filename, outputDir), repeats)
+    timings['isValidMesh'], valid = timeCall(lambda: isValidMesh(vertices, faces), repeats)
+
+    # What verifyMesh does when the quick check is not used: load the STL and let trimesh check it
+    def trimeshVerify():
+        mesh = trimesh.load(os.path.join(outputDir, filename))
+        return mesh.is_watertight and mesh.is_volume
+    timings['trimeshVerify'], watertight = timeCall(trimeshVerify, repeats)
+    os.remove(os.path.join(outputDir, filename))
+
+    return {'meshType': meshType, 'numFolds': numFolds, 'resolution': resolution, 'vertices': len(vertices), \
+            'faces': len(faces), 'valid': bool(valid), 'watertight': bool(watertight), 'seconds': timings, \
+            'total': sum(timings.values())}
+
+# Distance from every point to the nearest segment of a polyline, in chunks of points to bound the memory
+def getPolylineDistances(points, polyline, closed, chunkSize = 256):
+    starts = polyline if closed else polyline[:-1]
+    ends = np.roll(polyline, -1, axis=0) if closed else polyline[1:]
+    distances = np.empty(points.shape[0])
+    for start in range(0, points.shape[0], chunkSize):
+        chunk = points[start:start + chunkSize, None]
+        distances[start:start + chunkSize] = getSegmentSquaredDistances(chunk, starts, ends).min(axis=1)
+    return np.sqrt(distances)
+
+# Symmetric Hausdorff distance between two lofts of the same type and rings, measured ring by ring on the
+# outside and inside curves (decimated segments are sampled along their length). Both surfaces are ruled
+# between the same rings, so the distance between the rings also bounds the distance between the walls
+def getRingHausdorffDistance(vertices, faces, decimatedVertices, decimatedFaces, samplesPerSegment = 4):
+    meshType, numRings = getImpliedTopology(vertices, faces)
+    decimatedType, decimatedRings = getImpliedTopology(decimatedVertices, decimatedFaces)
+    if meshType == 'explicit' or (decimatedType, decimatedRings) != (meshType, numRings):
+        raise ValueError("Both meshes must be lofts of the same type and ring count")
+    closed = meshType in CLOSED_MESH_TYPES
+    curves = np.asarray(vertices, dtype=float)[:, [0, 2]].reshape(2 * numRings, -1, 2)
+    decimatedCurves = np.asarray(decimatedVertices, dtype=float)[:, [0, 2]].reshape(2 * numRings, -1, 2)
+    weights = (np.arange(samplesPerSegment) / samplesPerSegment)[:, None]
+    distance = 0.0
+    for curve, decimatedCurve in zip(curves, decimatedCurves):
+        starts = decimatedCurve if closed else decimatedCurve[:-1]
+        ends = np.roll(decimatedCurve, -1, axis=0) if closed else decimatedCurve[1:]
+        samples = (starts[:, None] + weights * (ends - starts)[:, None]).reshape(-1, 2)
+        distance = max(distance, getPolylineDistances(curve, decimatedCurve, closed).max(), \
+                       getPolylineDistances(samples, curve, closed).max())
+    return float(distance)
+
+# Decimate one mesh to every budget and compare it with the undecimated mesh
+def benchmarkDecimation(meshType, numFolds, resolution, repeats):
+    params = (meshType, numFolds, *FOLD_PARAMS, RADIUS, THICKNESS, resolution, False)
+    fullTime, (vertices, faces) = timeCall(lambda: GenerationEngine(RANDOM_SEED, stageCaches = None).generateMesh( \
+                                           *params, height = HEIGHT), repeats)
+    diagonal = float(np.linalg.norm(vertices.max(axis=0) - vertices.min(axis=0)))
+    cases = [{'meshType': meshType, 'numFolds': numFolds, 'resolution': resolution, 'budget': 1.0, 'faces': len(faces), \
+              'stlBytes': len(getSTLBytes(vertices, faces)), 'rfmBytes': len(getCompactBytes(vertices, faces)), \
+              'hausdorff': 0.0, 'relativeHausdorff': 0.0, 'seconds': fullTime}]
+    for budget in DECIMATION_BUDGETS:
+        maxFaces = int(len(faces) * budget)
+        seconds, (decimatedVertices, decimatedFaces) = timeCall(lambda: GenerationEngine(RANDOM_SEED, stageCaches = None, \
+                                                                maxFaces = maxFaces).generateMesh(*params, height = HEIGHT), repeats)
+        hausdorff = getRingHausdorffDistance(vertices, faces, decimatedVertices, decimatedFaces)
+        cases.append({'meshType': meshType, 'numFolds': numFolds, 'resolution': resolution, 'budget': budget, \
+                      'faces': len(decimatedFaces), 'stlBytes': len(getSTLBytes(decimatedVertices, decimatedFaces)), \
+                      'rfmBytes': len(getCompactBytes(decimatedVertices, decimatedFaces)), 'hausdorff': hausdorff, \
+                      'relativeHausdorff': hausdorff / diagonal, 'valid': bool(isValidMesh(decimatedVertices, decimatedFaces)), \
+                      'seconds': seconds})
+    return cases
+
+def runDecimationBenchmark(meshTypes = MESH_TYPES, foldCounts = DECIMATION_FOLD_COUNTS, \
+                           resolutions = DECIMATION_RESOLUTIONS, repeats = 3):
+    cases = []
+    for meshType in meshTypes:
+        for numFolds in foldCounts:
+            for resolution in resolutions:
+                for case in benchmarkDecimation(meshType, numFolds, resolution, repeats):
+                    print('{:<24} budget {:>4} {:>8} faces {:>9} STL bytes {:>8} RFM bytes Hausdorff {:.4f} ({:.3%}) {:>8.2f} ms'.format( \
+                        getCaseKey(case), case['budget'], case['faces'], case['stlBytes'], case['rfmBytes'], \
+                        case['hausdorff'], case['relativeHausdorff'], case['seconds'] * 1000))
+                    cases.append(case)
+    return cases
+
+def getCaseKey(case):
+    return '{}/{}/{}'.format(case['meshType'], case['numFolds'], case['resolution'])
+
+def getCommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, \
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def runBenchmark(meshTypes = MESH_TYPES, foldCounts = FOLD_COUNTS, resolutions = RESOLUTIONS, repeats = 3):
+    cases = []
+    with tempfile.TemporaryDirectory() as outputDir:
+        for meshType in meshTypes:
+            for numFolds in foldCounts:
+                for resolution in resolutions:
+                    try:
+                        case = benchmarkCase(meshType, numFolds, resolution, repeats, outputDir)
+                    except ValueError as error:
+                        case = {'meshType': meshType, 'numFolds': numFolds, 'resolution': resolution, 'error': str(error)}
+                        print('{:<24} skipped: {}'.format(getCaseKey(case), error))
+                    else:
+                        print('{:<24} {:>8} faces {:>10.2f} ms'.format(getCaseKey(case), case['faces'], case['total'] * 1000))
+                    cases.append(case)
+    return {'commit': getCommit(), 'python': platform.python_version(), 'numpy': np.__version__, \
+            'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'repeats': repeats, \
+            'cases': cases}
+
+# Stages slower than the baseline by more than threshold (a fraction), timings below minSeconds are
+# ignored in both runs since they are dominated by noise
+def findRegressions(baseline, results, threshold = 0.25, minSeconds = 0.001):
+    baselineCases = {getCaseKey(case): case for case in baseline['cases'] if 'seconds' in case}
+    regressions = []
+    for case in results['cases']:
+        previous = baselineCases.get(getCaseKey(case))
+        if previous is None or 'seconds' not in case:
+            continue
+        for stage, seconds in case['seconds'].items():
+            before = previous['seconds'].get(stage)
+            if before is None or max(before, seconds) < minSeconds:
+                continue
+            if seconds > before * (1 + threshold):
+                regressions.append((getCaseKey(case), stage, before, seconds))
+    return regressions
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description='Benchmark the ruffle generation stages')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file the results are written to')
+    parser.add_argument('--baseline', help='Earlier result file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.25, help='Allowed slowdown per stage, 0.25 = 25%%')
+    parser.add_argument('--repeats', type=int, default=3, help='Runs per stage, the best time is kept')
+    parser.add_argument('--types', nargs='+', default=list(MESH_TYPES), choices=MESH_TYPES)
+    parser.add_argument('--quick', action='store_true', help='Only sweep a few fold counts and resolutions')
+    parser.add_argument('--decimate', action='store_true', help='Also compare decimated meshes with the full ones')
+    args = parser.parse_args(argv)
+
+    results = runBenchmark(args.types, QUICK_FOLD_COUNTS if args.quick else FOLD_COUNTS, \
+                           QUICK_RESOLUTIONS if args.quick else RESOLUTIONS, args.repeats)
+    if args.decimate:
+        results['decimation'] = runDecimationBenchmark(args.types, DECIMATION_FOLD_COUNTS[-1:] if args.quick \
+                                                       else DECIMATION_FOLD_COUNTS, DECIMATION_RESOLUTIONS[:1] \
+                                                       if args.quick else DECIMATION_RESOLUTIONS, args.repeats)
+    with open(args.output, 'w') as outputFile:
+        json.dump(results, outputFile, indent=2)
+    print('Results written to {}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as baselineFile:
+            baseline = json.load(baselineFile)
+        regressions = findRegressions(baseline, results, args.threshold)
+        for key, stage, before, after in regressions:
+            print('REGRESSION {} {}: {:.3f} ms -> {:.3f} ms'.format(key, stage, before * 1000, after * 1000))
+        if regressions:
+            return 1
+        print('No stage slower than {:.0%} over {} ({})'.format(args.threshold, args.baseline, baseline.get('commit')))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,227 +1,539 @@
+import json, os
 import numpy as np
-from stl import mesh
-# To show the model using matplotlib
-from mpl_toolkits import mplot3d
-from matplotlib import pyplot
-import trimesh
 
 from hemline_bspline import generateControlPointsFullCircle, generateControlPointsPolar, getCurvePoints, testCartesian, testPolar, testFullCircle
 from hemline_thickness import testThickness, thickenHemline
+from stage_cache import StageCache
 
-def makeCoordsPositive(coordinates):
-    minX = np.min(coordinates[:, 0])
-    minY = np.min(coordinates[:, 1])
-    # Element-wise addition to all elements in the coordinate to shift the curve to the first quadrant
-    coordinates[:, 0] = coordinates[:, 0] - minX
-    coordinates[:, 1] = coordinates[:, 1] - minY
-    return coordinates
+# Dtypes of the generated meshes, STL, PLY and GLB store float32 positions and 32 bit indices anyway
+MESH_VERTEX_DTYPE = np.float32
+MESH_INDEX_DTYPE = np.int32
 
-def makeCurtain(outsideCurve, insideCurve, height = 5):
+# Offset that moves both curves into the first quadrant (x and y of the lowest point become 0)
+def getPositiveOrigin(*curves):
+    return (min(np.min(curve[:, 0]) for curve in curves), min(np.min(curve[:, 1]) for curve in curves))
+
+# Mesh types with their open ends closed by two extra faces on each side
+CAPPED_MESH_TYPES = ('curtain', 'cape')
+# Mesh types built from closed hemlines, their last facet group wraps around to the first points
+CLOSED_MESH_TYPES = ('tube', 'skirt')
+
+# Build the face indices for a loft of numRings rings of 2 * n vertices (outside curve then inside curve),
+# bottom ring first. Every mesh type gives a closed, consistently wound (outward facing) surface, the faces of
+# two rings keep the order of the original two ring loft (caps, then the walls of every ring pair, per point)
+def buildFaceTopology(meshType, n, numRings = 2):
+    nn = 2 * n
+    if meshType in CLOSED_MESH_TYPES:
+        x = np.arange(n, dtype=MESH_INDEX_DTYPE)[:, None]
+        x1 = (x + 1) % n # Connect the last point back to the first one
+    else:
+        x = np.arange(n - 1, dtype=MESH_INDEX_DTYPE)[:, None] # The last one on the other side ignored
+        x1 = x + 1
+    top = (numRings - 1) * nn # First vertex of the top ring
+    caps = np.stack([
+        # Top and bottom pieces
+        np.hstack((x, x1+n, x1)), # Bottom piece 1
+        np.hstack((x, x+n, x1+n)), # Bottom piece 2
+        np.hstack((x+top, x1+top, x1+n+top)), # Top piece 3
+        np.hstack((x+top, x1+n+top, x+n+top)), # Top piece 4
+    ], axis=1)
+    walls = np.stack([
+        # Side walls (right)
+        np.hstack((x, x1, x1+nn)), # Side wall piece 5
+        np.hstack((x, x1+nn, x+nn)), # Side wall piece 6
+        # Side walls (left)
+        np.hstack((x1+n, x+nn+n, x1+nn+n)), # Side wall piece 9
+        np.hstack((x1+n, x+n, x+nn+n)), # Side wall piece 10
+    ], axis=1)
+    # The same walls between every pair of consecutive rings, shifted by one ring each
+    ringOffsets = np.arange(numRings - 1, dtype=MESH_INDEX_DTYPE)[:, None, None] * nn
+    walls = (walls[:, None] + ringOffsets).reshape(x.shape[0], -1, 3)
+    facetGroups = np.concatenate((caps, walls), axis=1).reshape(-1, 3)
+    if meshType in CAPPED_MESH_TYPES:
+        # Add 2 leftmost and 2 rightmost faces between every pair of rings
+        leftFaces = np.array([[0, n+nn, n], [n+nn, 0, nn]], dtype=MESH_INDEX_DTYPE) + ringOffsets
+        rightFaces = np.array([[n-1, nn-1, n+nn-1], [nn-1, nn+nn-1, n+nn-1]], dtype=MESH_INDEX_DTYPE) + ringOffsets
+        facetGroups = np.vstack((leftFaces.reshape(-1, 3), facetGroups, rightFaces.reshape(-1, 3)))
+    return facetGroups
+
+# Face topologies for repeated resolutions, bounded by bytes since a 128 ring loft of a fine hemline takes
+# about 60 MB, RUFFLE_TOPOLOGY_CACHE_BYTES is the budget (topologies larger than it are not cached)
+FACE_TOPOLOGY_CACHE = StageCache(int(os.environ.get('RUFFLE_TOPOLOGY_CACHE_BYTES', 32 * 1024 * 1024)))
+
+# The face indices of a loft, see buildFaceTopology. The connectivity only depends on the mesh type, n and the
+# ring count, so it is cached. The returned array is shared between callers and must not be modified
+def getFaceTopology(meshType, n, numRings = 2):
+    return FACE_TOPOLOGY_CACHE.get((meshType, n, numRings), lambda: buildFaceTopology(meshType, n, numRings))
+
+# Drop the last point of closed curves when it repeats the first one (clamped full circle curves),
+# the closed mesh types connect the last point back to the first one themselves
+def removeSeamPoint(*curves):
+    if curves[0].shape[0] > 1 and np.allclose(curves[0][0], curves[0][-1]):
+        return [curve[:-1] for curve in curves]
+    return list(curves)
+
+# Reusable output buffers that grow to the largest mesh requested, so a worker can fill the same memory
+# for every mesh instead of allocating new arrays. The arrays returned by the builders are views into them,
+# so they are only valid until the next mesh is built with the same buffers
+class MeshBuffers:
+    def __init__(self):
+        self.vertices = np.empty((0, 3), dtype=MESH_VERTEX_DTYPE)
+        self.faces = np.empty((0, 3), dtype=MESH_INDEX_DTYPE)
+
+    def get(self, numVertices, numFaces):
+        if self.vertices.shape[0] < numVertices:
+            self.vertices = np.empty((numVertices, 3), dtype=MESH_VERTEX_DTYPE)
+        if self.faces.shape[0] < numFaces:
+            self.faces = np.empty((numFaces, 3), dtype=MESH_INDEX_DTYPE)
+        return self.vertices, self.faces
+
+# Views of the first rows of a caller provided buffer, which must be large enough and of the mesh dtype
+def getBufferView(buffer, rows, dtype, name):
+    if buffer.dtype != dtype or buffer.ndim != 2 or buffer.shape[1] != 3 or buffer.shape[0] < rows:
+        raise ValueError("The {} buffer must be a ({}+, 3) {} array".format(name, rows, np.dtype(dtype).name))
+    return buffer[:rows]
+
+# Number of rings lofted from numKeyRings rings with ringsBetween interpolated rings between each pair
+def getRingCount(numKeyRings, ringsBetween = 0):
+    return (numKeyRings - 1) * (ringsBetween + 1) + 1
+
+# Loft a stack of rings (each the outside curve followed by the inside curve), bottom ring first, into a mesh
+# rings are lofted at the given heights, with ringsBetween rings linearly interpolated between every pair of
+# consecutive rings, which splits the long side triangles and blends the folds of one ring into the next.
+# The vertices are written once, in place, into a float32 array of the final size in Y-up order
+# (x, height, y), shifted by origin. Without out the faces are the shared read-only topology, out can be
+# a MeshBuffers instance or a (vertices, faces) tuple of caller arrays (either may be None) to write into
+def loftRingStack(rings, heights, meshType, ringsBetween = 0, origin = (0.0, 0.0), out = None):
+    n = rings[0][0].shape[0]
+    step = ringsBetween + 1
+    numRings = getRingCount(len(rings), ringsBetween)
+    topology = getFaceTopology(meshType, n, numRings)
+    if isinstance(out, MeshBuffers):
+        out = out.get(2 * n * numRings, topology.shape[0])
+    vertexBuffer, faceBuffer = out if out is not None else (None, None)
+    if vertexBuffer is None:
+        vertices = np.empty((2 * n * numRings, 3), dtype=MESH_VERTEX_DTYPE)
+    else:
+        vertices = getBufferView(vertexBuffer, 2 * n * numRings, MESH_VERTEX_DTYPE, 'vertex')
+    ringVertices = vertices.reshape(numRings, 2 * n, 3)
+    for index, (outCurve, inCurve) in enumerate(rings):
+        for rows, curve in ((ringVertices[index * step, :n], outCurve), (ringVertices[index * step, n:], inCurve)):
+            np.subtract(curve[:, 0], origin[0], out=rows[:, 0])
+            np.subtract(curve[:, 1], origin[1], out=rows[:, 2])
+        ringVertices[index * step, :, 1] = heights[index]
+    if ringsBetween > 0:
+        # Every interpolated ring (heights included) of a ring pair in one pass over the pair
+        weights = (np.arange(1, step, dtype=MESH_VERTEX_DTYPE) / step)[:, None, None]
+        for index in range(len(rings) - 1):
+            lower = ringVertices[index * step]
+            upper = ringVertices[(index + 1) * step]
+            between = ringVertices[index * step + 1:(index + 1) * step]
+            np.multiply(weights, upper - lower, out=between)
+            between += lower
+    if faceBuffer is None:
+        return vertices, topology
+    faces = getBufferView(faceBuffer, topology.shape[0], MESH_INDEX_DTYPE, 'face')
+    faces[:] = topology
+    return vertices, faces
+
+# ringsBetween rings are interpolated between the bottom and the top ring of every builder, see loftRingStack
+def makeCurtain(outsideCurve, insideCurve, height = 5, out = None, ringsBetween = 0):
     if (outsideCurve.shape[0] == 0) or (insideCurve.shape[0]) == 0 or (outsideCurve.shape[0] != insideCurve.shape[0]):
         # Do not process if the dimensions do not match
         return None
-    # Make faces using indexing of allVertices
-    totalFacetGroups = outsideCurve.shape[0]
-    # Combine to two curves into one
-    combinedCurve = np.vstack((outsideCurve, insideCurve))
-    # Make the two curves positive
-    combinedCurve = makeCoordsPositive(combinedCurve)
-    totalPoints = combinedCurve.shape[0]
-    height = np.zeros((totalPoints, 1)) + height
-    bottomCurve = np.hstack((combinedCurve, np.zeros((totalPoints, 1))))
-    topCurve = np.hstack((combinedCurve, height))
-    # Combine the top curve and bottom curve
-    allVertices = np.vstack((bottomCurve, topCurve))
-    # Swap indexing
-    allVertices[:, [1, 2]] = allVertices[:, [2, 1]]
-    allFaces = []
-    # Constants used in loop
-    n = totalFacetGroups
-    nn = totalPoints
-    # Add 2 leftmost faces
-    allFaces.append([0, n+nn, n])
-    allFaces.append([n+nn, 0, nn])
-    for x in range(n - 1): # The last one on the other side ignored
-       # Top and bottom pieces
-       allFaces.append([x, x+n+1, x+1]) # Bottom piece 1
-       allFaces.append([x, x+n, x+n+1]) # Bottom piece 2
-       allFaces.append([x+nn, x+1+nn, x+n+1+nn]) # Top piece 3
-       allFaces.append([x+nn, x+n+nn+1, x+n+nn]) # Top piece 4
-       # Side walls (right)
-       allFaces.append([x, x+1, x+nn+1]) # Side wall piece 5
-       allFaces.append([x, x+nn+1, x+nn]) # Side wall piece 6
-       #allFaces.append([x+1, x+n+1, x+nn+1]) # Side wall piece 7
-       #allFaces.append([x+n+1, x+nn+n+1, x+nn+1]) # Side wall piece 8
-       # Side walls (left)
-       allFaces.append([x+n+1, x+nn+n, x+nn+n+1]) # Side wall piece 9
-       allFaces.append([x+n+1, x+n, x+nn+n]) # Side wall piece 10
-       #allFaces.append([x, x+nn, x+nn+n]) # Side wall piece 11
-       #allFaces.append([x, x+n+nn, x+n]) # Side wall piece 12
-    # Add 2 rightmost faces
-    allFaces.append([n-1, nn-1, n+nn-1])
-    allFaces.append([nn-1, nn+nn-1, n+nn-1])
-    return np.array(allVertices), np.array(allFaces)
-
-def makeCurtainFullCircle(outsideCurve, insideCurve, height = 5):
+    # Loft the curve onto itself, moved into the first quadrant
+    return loftRingStack(((outsideCurve, insideCurve),) * 2, (0, height), 'curtain', ringsBetween, \
+                         origin = getPositiveOrigin(outsideCurve, insideCurve), out = out)
+
+def makeCurtainFullCircle(outsideCurve, insideCurve, height = 5, out = None, ringsBetween = 0):
     if (outsideCurve.shape[0] == 0) or (insideCurve.shape[0]) == 0 or (outsideCurve.shape[0] != insideCurve.shape[0]):
         # Do not process if the dimensions do not match
         return None
-    # Make faces using indexing of allVertices
-    totalFacetGroups = outsideCurve.shape[0]
-    # Combine to two curves into one
-    combinedCurve = np.vstack((outsideCurve, insideCurve))
-    # Make the two curves positive
-    combinedCurve = makeCoordsPositive(combinedCurve)
-    totalPoints = combinedCurve.shape[0]
-    height = np.zeros((totalPoints, 1)) + height
-    bottomCurve = np.hstack((combinedCurve, np.zeros((totalPoints, 1))))
-    topCurve = np.hstack((combinedCurve, height))
-    # Combine the top curve and bottom curve
-    allVertices = np.vstack((bottomCurve, topCurve))
-    # Swap indexing
-    allVertices[:, [1, 2]] = allVertices[:, [2, 1]]
-    allFaces = []
-    # Constants used in loop
-    n = totalFacetGroups
-    nn = totalPoints
-    for x in range(n - 1): # The last one on the other side ignored
-       # Top and bottom pieces
-       allFaces.append([x, x+n+1, x+1]) # Bottom piece 1
-       allFaces.append([x, x+n, x+n+1]) # Bottom piece 2
-       allFaces.append([x+nn, x+1+nn, x+n+1+nn]) # Top piece 3
-       allFaces.append([x+nn, x+n+nn+1, x+n+nn]) # Top piece 4
-       # Side walls (right)
-       allFaces.append([x, x+1, x+nn+1]) # Side wall piece 5
-       allFaces.append([x, x+nn+1, x+nn]) # Side wall piece 6
-       #allFaces.append([x+1, x+n+1, x+nn+1]) # Side wall piece 7
-       #allFaces.append([x+n+1, x+nn+n+1, x+nn+1]) # Side wall piece 8
-       # Side walls (left)
-       allFaces.append([x+n+1, x+nn+n, x+nn+n+1]) # Side wall piece 9
-       allFaces.append([x+n+1, x+n, x+nn+n]) # Side wall piece 10
-       #allFaces.append([x, x+nn, x+nn+n]) # Side wall piece 11
-       #allFaces.append([x, x+n+nn, x+n]) # Side wall piece 12
-    return np.array(allVertices), np.array(allFaces)
-
-def makeCape(bottomOutCurve, bottomInCurve, topOutCurve, topInCurve, height = 5):
-    if (bottomOutCurve.shape[0] == 0) or (bottomInCurve.shape[0] == 0) \
-        or (topOutCurve.shape[0] == 0) or (topInCurve.shape[0] == 0) \
-        or (bottomOutCurve.shape[0] != bottomInCurve.shape[0]) \
-        or (bottomOutCurve.shape[0] != topOutCurve.shape[0]) \
-        or (bottomOutCurve.shape[0] != topInCurve.shape[0]):
-        # Do not process if the dimensions do not match or are invalid
-        return None
-    # Make faces using indexing of allVertices
-    totalFacetGroups = bottomOutCurve.shape[0]
-    # Combine to two curves into one
-    combinedBottomCurve = np.vstack((bottomOutCurve, bottomOutCurve))
-    combinedTopCurve = np.vstack((topOutCurve, topInCurve))
-    # Make the two curves positive
-    #combinedBottomCurve = makeCoordsPositive(combinedBottomCurve)
-    #combinedTopCurve = makeCoordsPositive(combinedTopCurve)
-    totalPoints = combinedBottomCurve.shape[0]
-    height = np.zeros((totalPoints, 1)) + height
-    bottomCurve = np.hstack((combinedBottomCurve, np.zeros((totalPoints, 1))))
-    topCurve = np.hstack((combinedTopCurve, height))
-    # Combine the top curve and bottom curve
-    allVertices = np.vstack((bottomCurve, topCurve))
-    # Swap indexing
-    allVertices[:, [1, 2]] = allVertices[:, [2, 1]]
-    allFaces = []
-    # Constants used in loop
-    n = totalFacetGroups
-    nn = totalPoints
-    # Add 2 leftmost faces
-    allFaces.append([0, n+nn, n])
-    allFaces.append([n+nn, 0, nn])
-    for x in range(n - 1): # The last one on the other side ignored
-       # Top and bottom pieces
-       allFaces.append([x, x+n+1, x+1]) # Bottom piece 1
-       allFaces.append([x, x+n, x+n+1]) # Bottom piece 2
-       allFaces.append([x+nn, x+1+nn, x+n+1+nn]) # Top piece 3
-       allFaces.append([x+nn, x+n+nn+1, x+n+nn]) # Top piece 4
-       # Side walls (right)
-       allFaces.append([x, x+1, x+nn+1]) # Side wall piece 5
-       allFaces.append([x, x+nn+1, x+nn]) # Side wall piece 6
-       #allFaces.append([x+1, x+n+1, x+nn+1]) # Side wall piece 7
-       #allFaces.append([x+n+1, x+nn+n+1, x+nn+1]) # Side wall piece 8
-       # Side walls (left)
-       allFaces.append([x+n+1, x+nn+n, x+nn+n+1]) # Side wall piece 9
-       allFaces.append([x+n+1, x+n, x+nn+n]) # Side wall piece 10
-       #allFaces.append([x, x+nn, x+nn+n]) # Side wall piece 11
-       #allFaces.append([x, x+n+nn, x+n]) # Side wall piece 12
-    # Add 2 rightmost faces
-    allFaces.append([n-1, nn-1, n+nn-1])
-    allFaces.append([nn-1, nn+nn-1, n+nn-1])
-    return np.array(allVertices), np.array(allFaces)
-
-def makeSkirt(bottomOutCurve, bottomInCurve, topOutCurve, topInCurve, height = 5):
-    if (bottomOutCurve.shape[0] == 0) or (bottomInCurve.shape[0] == 0) \
-        or (topOutCurve.shape[0] == 0) or (topInCurve.shape[0] == 0) \
-        or (bottomOutCurve.shape[0] != bottomInCurve.shape[0]) \
-        or (bottomOutCurve.shape[0] != topOutCurve.shape[0]) \
-        or (bottomOutCurve.shape[0] != topInCurve.shape[0]):
+    outsideCurve, insideCurve = removeSeamPoint(outsideCurve, insideCurve)
+    return loftRingStack(((outsideCurve, insideCurve),) * 2, (0, height), 'tube', ringsBetween, \
+                         origin = getPositiveOrigin(outsideCurve, insideCurve), out = out)
+
+def makeCape(bottomOutCurve, bottomInCurve, topOutCurve, topInCurve, height = 5, out = None, ringsBetween = 0):
+    return makeRingStack(((bottomOutCurve, bottomInCurve), (topOutCurve, topInCurve)), (0, height), 'cape', \
+                         ringsBetween, out = out)
+
+def makeSkirt(bottomOutCurve, bottomInCurve, topOutCurve, topInCurve, height = 5, out = None, ringsBetween = 0):
+    return makeRingStack(((bottomOutCurve, bottomInCurve), (topOutCurve, topInCurve)), (0, height), 'skirt', \
+                         ringsBetween, out = out)
+
+# Loft any number of thick hemlines (outsideCurve, insideCurve), bottom first, at the given heights into a
+# cape or skirt, e.g. a tiered skirt with one ruffled hemline per tier
+def makeRingStack(rings, heights, meshType, ringsBetween = 0, out = None):
+    curves = [curve for ring in rings for curve in ring]
+    if len(rings) < 2 or len(heights) != len(rings) \
+        or any(curve.shape[0] == 0 or curve.shape[0] != curves[0].shape[0] for curve in curves):
         # Do not process if the dimensions do not match or are invalid
         return None
-    # Make faces using indexing of allVertices
-    totalFacetGroups = bottomOutCurve.shape[0]
-    # Combine to two curves into one
-    combinedBottomCurve = np.vstack((bottomOutCurve, bottomOutCurve))
-    combinedTopCurve = np.vstack((topOutCurve, topInCurve))
-    # Make the two curves positive
-    #combinedBottomCurve = makeCoordsPositive(combinedBottomCurve)
-    #combinedTopCurve = makeCoordsPositive(combinedTopCurve)
-    totalPoints = combinedBottomCurve.shape[0]
-    height = np.zeros((totalPoints, 1)) + height
-    bottomCurve = np.hstack((combinedBottomCurve, np.zeros((totalPoints, 1))))
-    topCurve = np.hstack((combinedTopCurve, height))
-    # Combine the top curve and bottom curve
-    allVertices = np.vstack((bottomCurve, topCurve))
-    # Swap indexing
-    allVertices[:, [1, 2]] = allVertices[:, [2, 1]]
-    allFaces = []
-    # Constants used in loop
-    n = totalFacetGroups
-    nn = totalPoints
-    for x in range(n - 1): # The last one on the other side ignored
-       # Top and bottom pieces
-       allFaces.append([x, x+n+1, x+1]) # Bottom piece 1
-       allFaces.append([x, x+n, x+n+1]) # Bottom piece 2
-       allFaces.append([x+nn, x+1+nn, x+n+1+nn]) # Top piece 3
-       allFaces.append([x+nn, x+n+nn+1, x+n+nn]) # Top piece 4
-       # Side walls (right)
-       allFaces.append([x, x+1, x+nn+1]) # Side wall piece 5
-       allFaces.append([x, x+nn+1, x+nn]) # Side wall piece 6
-       #allFaces.append([x+1, x+n+1, x+nn+1]) # Side wall piece 7
-       #allFaces.append([x+n+1, x+nn+n+1, x+nn+1]) # Side wall piece 8
-       # Side walls (left)
-       allFaces.append([x+n+1, x+nn+n, x+nn+n+1]) # Side wall piece 9
-       allFaces.append([x+n+1, x+n, x+nn+n]) # Side wall piece 10
-       #allFaces.append([x, x+nn, x+nn+n]) # Side wall piece 11
-       #allFaces.append([x, x+n+nn, x+n]) # Side wall piece 12
-
-    return np.array(allVertices), np.array(allFaces)
+    if meshType in CLOSED_MESH_TYPES:
+        curves = removeSeamPoint(*curves)
+    return loftRingStack(list(zip(curves[0::2], curves[1::2])), heights, meshType, ringsBetween, out = out)
 
-def makeSTL(vertices, faces, filename='curtain.stl', dir='.'):
-    # Create the mesh
-    generatedMesh = mesh.Mesh(np.zeros(faces.shape[0], dtype=mesh.Mesh.dtype))
-    for i, f in enumerate(faces):
-        for j in range(3):
-            generatedMesh.vectors[i][j] = vertices[f[j], :]
+# Faces of a loft of numRings rings of n points, see getFaceTopology
+def getLoftFaceCount(meshType, n, numRings = 2):
+    if meshType in CLOSED_MESH_TYPES:
+        return 4 * n * numRings
+    return 4 * (n - 1) * numRings + (4 * (numRings - 1) if meshType in CAPPED_MESH_TYPES else 0)
+
+# Most points per ring that keep a loft of numRings rings within maxFaces
+def getColumnBudget(meshType, maxFaces, numRings = 2):
+    if meshType in CLOSED_MESH_TYPES:
+        return maxFaces // (4 * numRings)
+    return (maxFaces - (4 * (numRings - 1) if meshType in CAPPED_MESH_TYPES else 0)) // (4 * numRings) + 1
+
+# Squared distance from every point to the segment between a and b (arrays of the same shape, (..., 2))
+def getSegmentSquaredDistances(points, a, b):
+    direction = b - a
+    offsets = points - a
+    lengths = np.einsum('...i,...i->...', direction, direction)
+    t = np.clip(np.einsum('...i,...i->...', offsets, direction) / np.where(lengths > 0, lengths, 1.0), 0.0, 1.0)
+    offsets -= t[..., None] * direction
+    return np.einsum('...i,...i->...', offsets, offsets)
+
+# Signed areas of the two cap triangles (outside[a], inside[b], outside[b]) and (outside[a], inside[a], inside[b])
+# of the strips between (outside, inside) curve pairs, from column a to column b, shape (numPairs, 2, ...)
+def getStripAreas(curves, a, b):
+    outA, outB, inA, inB = curves[0::2, a], curves[0::2, b], curves[1::2, a], curves[1::2, b]
+    def cross(p, q, r):
+        return (q[..., 0] - p[..., 0]) * (r[..., 1] - p[..., 1]) - (q[..., 1] - p[..., 1]) * (r[..., 0] - p[..., 0])
+    return np.stack((cross(outA, inB, outB), cross(outA, inA, inB)), axis=1)
+
+# Errors of removing the kept columns at positions (indices into kept), see getDecimatedColumns
+# With the strip orientations (one sign per curve pair) a removal that turns a cap triangle inside out costs inf
+def getColumnErrors(curves, kept, positions, orientations = None):
+    n = curves.shape[1]
+    prevColumns = kept[(positions - 1) % kept.shape[0]]
+    nextColumns = kept[(positions + 1) % kept.shape[0]]
+    # Every original point between the two neighbours of each column, the column included
+    spans = (nextColumns - prevColumns - 1) % n
+    starts = np.cumsum(spans) - spans
+    owners = np.repeat(np.arange(spans.shape[0]), spans)
+    points = (prevColumns[owners] + 1 + np.arange(owners.shape[0]) - starts[owners]) % n
+    distances = getSegmentSquaredDistances(curves[:, points], curves[:, prevColumns[owners]], curves[:, nextColumns[owners]])
+    errors = np.sqrt(np.maximum.reduceat(distances.max(axis=0), starts))
+    if orientations is not None:
+        areas = getStripAreas(curves, prevColumns, nextColumns) * orientations[:, None, None]
+        errors[(areas <= 0).any(axis=(0, 1))] = np.inf
+    return errors
+
+# Choose the columns (the point index shared by every curve of a loft) to keep when simplifying the curves
+# Removing a column replaces the curve points between its two kept neighbours by a straight segment, its
+# error is the largest distance of any original point of that stretch, on any curve, from the segment, so
+# fold crests and the fold bases next to straight stretches are the last columns to go. Columns are removed
+# in rounds: each round takes the columns within tolerance (or the cheapest as many as still have to go
+# for maxColumns, at most half of them) and removes every other one of each run of them, so two neighbours
+# are never removed against stale errors. Only the neighbours of removed columns get their error updated
+# The end columns of open curves, which carry the end caps, and the keepColumns are always kept
+# With strips the curves are (outside, inside) pairs lofted into caps, and a removal that would turn a cap
+# triangle between them inside out is never made, so a low maxColumns may not be reached
+# Returns the kept column indices and the largest error of a removal
+def getDecimatedColumns(curves, closed, maxColumns = None, tolerance = 0.0, keepColumns = (), strips = False):
+    curves = np.asarray(curves, dtype=np.float64)[..., :2] # (numCurves, n, 2)
+    n = curves.shape[1]
+    minColumns = 3 if closed else 2
+    target = max(minColumns, maxColumns if maxColumns is not None else n)
+    kept = np.arange(n)
+    pinned = np.zeros(n, dtype=bool)
+    pinned[list(keepColumns)] = True
+    if not closed:
+        pinned[[0, -1]] = True
+    orientations = None
+    if strips:
+        # Winding of every strip before simplifying, the caps of a thick hemline all turn the same way
+        columns = np.arange(n if closed else n - 1)
+        orientations = np.sign(getStripAreas(curves, columns, (columns + 1) % n).sum(axis=(1, 2)))
+    errors = np.where(pinned, np.inf, getColumnErrors(curves, kept, np.arange(n), orientations))
+    maxError = 0.0
+    while kept.shape[0] > minColumns:
+        excess = kept.shape[0] - target
+        threshold = tolerance
+        if excess > 0:
+            rank = min(excess, kept.shape[0] // 2)
+            threshold = max(threshold, np.partition(errors, rank)[rank])
+        selected = (errors <= threshold) & np.isfinite(errors)
+        # Every other column of each run of selected columns, counted from the start of the run
+        runStarts = np.flatnonzero(selected & ~np.concatenate(([False], selected[:-1])))
+        if runStarts.shape[0] == 0:
+            break
+        runOffsets = np.arange(selected.shape[0]) - runStarts[np.maximum(np.searchsorted(runStarts, \
+                                                                     np.arange(selected.shape[0]), 'right') - 1, 0)]
+        selected &= runOffsets % 2 == 0
+        if closed and selected[0] and selected[-1]:
+            selected[-1] = False # Neighbours across the seam
+        removed = np.flatnonzero(selected)
+        removed = removed[np.argsort(errors[removed], kind='stable')]
+        count = min(max(np.count_nonzero(errors[removed] <= tolerance), min(excess, removed.shape[0])), \
+                    kept.shape[0] - minColumns)
+        if count <= 0:
+            break
+        maxError = max(maxError, float(errors[removed[count - 1]]))
+        removed = np.sort(removed[:count])
+        kept = np.delete(kept, removed)
+        errors = np.delete(errors, removed)
+        pinned = np.delete(pinned, removed)
+        # Positions of the columns on both sides of every removed one after the removal
+        after = removed - np.arange(removed.shape[0])
+        dirty = np.unique(np.concatenate((after - 1, after)) % kept.shape[0])
+        errors[dirty] = np.where(pinned[dirty], np.inf, getColumnErrors(curves, kept, dirty, orientations))
+    return kept, maxError
+
+# Simplify the thick hemlines (outsideCurve, insideCurve) of a loft so the mesh fits in maxFaces faces and/or
+# drops every point that moves the hemlines by at most tolerance, see getDecimatedColumns
+# numRings is the number of rings the result is lofted from (interpolated rings included), every ring keeps
+# the same columns so the result lofts like the original. The lowest x and y points are kept so curtains and
+# tubes are moved by the same getPositiveOrigin offset. Raises ValueError when maxFaces can only be reached by
+# folding a hemline over itself, which would turn the mesh inside out. Returns the simplified rings and the largest error
+def decimateRings(rings, meshType, maxFaces = None, tolerance = 0.0, numRings = 2):
+    curves = [curve for ring in rings for curve in ring]
+    closed = meshType in CLOSED_MESH_TYPES
+    if closed:
+        curves = removeSeamPoint(*curves)
+    maxColumns = None
+    if maxFaces is not None:
+        maxColumns = getColumnBudget(meshType, maxFaces, numRings)
+        if maxColumns < (3 if closed else 2):
+            raise ValueError("A {} lofted from {} rings needs at least {} faces".format(
+                meshType, numRings, getLoftFaceCount(meshType, 3 if closed else 2, numRings)))
+    points = np.stack([np.asarray(curve)[:, :2] for curve in curves])
+    lowestColumns = [np.argmin(points[..., axis]) % points.shape[1] for axis in (0, 1)]
+    kept, maxError = getDecimatedColumns(points, closed, maxColumns, tolerance, lowestColumns, strips = True)
+    if maxColumns is not None and kept.shape[0] > maxColumns:
+        raise ValueError("This {} needs at least {} faces, fewer would fold its hemlines over themselves".format(
+            meshType, getLoftFaceCount(meshType, kept.shape[0], numRings)))
+    curves = [np.asarray(curve)[kept] for curve in curves]
+    return list(zip(curves[0::2], curves[1::2])), maxError
 
+# One 50 byte binary STL record: facet normal, 3 vertices and the attribute byte count
+STL_RECORD_DTYPE = np.dtype([('normal', '<f4', (3,)), ('vectors', '<f4', (3, 3)), ('attr', '<u2')])
+STL_HEADER = b'RuffleGenerator binary STL'.ljust(80, b' ')
+
+# Serialize the mesh as binary STL, filling the records directly inside the output buffer
+def getSTLBytes(vertices, faces):
+    buffer = bytearray(84 + faces.shape[0] * STL_RECORD_DTYPE.itemsize)
+    buffer[:80] = STL_HEADER
+    buffer[80:84] = np.uint32(faces.shape[0]).tobytes()
+    records = np.frombuffer(buffer, dtype=STL_RECORD_DTYPE, offset=84)
+    # Gather all triangle corners at once
+    triangles = np.asarray(vertices)[faces]
+    records['vectors'] = triangles
+    # Unit facet normals, degenerate triangles get a zero normal
+    # The edges are taken in float64, the cross product of thin float32 triangles loses too much precision
+    normals = np.cross(np.subtract(triangles[:, 1], triangles[:, 0], dtype=np.float64), \
+                       np.subtract(triangles[:, 2], triangles[:, 0], dtype=np.float64))
+    lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+    np.divide(normals, lengths, out=normals, where=lengths > 0)
+    records['normal'] = normals
+    return buffer
+
+# Serialize the indexed mesh as binary little endian PLY (shared vertices, no per-facet data)
+def getPLYBytes(vertices, faces):
+    header = ("ply\nformat binary_little_endian 1.0\ncomment RuffleGenerator\n"
+              "element vertex {}\nproperty float x\nproperty float y\nproperty float z\n"
+              "element face {}\nproperty list uchar int vertex_indices\nend_header\n"
+              ).format(len(vertices), len(faces)).encode('ascii')
+    faceDtype = np.dtype([('count', 'u1'), ('indices', '<i4', (3,))]) # Packed, 13 bytes per face
+    buffer = bytearray(len(header) + len(vertices) * 12 + len(faces) * faceDtype.itemsize)
+    buffer[:len(header)] = header
+    vertexRecords = np.frombuffer(buffer, dtype='<f4', count=len(vertices) * 3, offset=len(header))
+    vertexRecords[:] = np.asarray(vertices).ravel()
+    faceRecords = np.frombuffer(buffer, dtype=faceDtype, offset=len(header) + len(vertices) * 12)
+    faceRecords['count'] = 3
+    faceRecords['indices'] = faces
+    return buffer
+
+# Serialize the indexed mesh as glTF binary (GLB) with one triangle primitive
+# Positions are float32, indices uint16 when every vertex fits, uint32 otherwise
+def getGLBBytes(vertices, faces):
+    positions = np.ascontiguousarray(vertices, dtype='<f4')
+    indexType, componentType = ('<u2', 5123) if len(positions) <= 0xFFFF else ('<u4', 5125)
+    indices = np.ascontiguousarray(faces, dtype=indexType).ravel()
+    positionBytes = positions.nbytes
+    indexBytes = indices.nbytes
+    binLength = positionBytes + indexBytes + (-(positionBytes + indexBytes) % 4) # Chunks are 4 byte aligned
+    gltf = {
+        "asset": {"version": "2.0", "generator": "RuffleGenerator"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [{"attributes": {"POSITION": 0}, "indices": 1, "mode": 4}]}],
+        "buffers": [{"byteLength": binLength}],
+        "bufferViews": [
+            {"buffer": 0, "byteOffset": 0, "byteLength": positionBytes, "target": 34962},
+            {"buffer": 0, "byteOffset": positionBytes, "byteLength": indexBytes, "target": 34963},
+        ],
+        "accessors": [
+            {"bufferView": 0, "componentType": 5126, "count": len(positions), "type": "VEC3",
+             "min": positions.min(axis=0).tolist(), "max": positions.max(axis=0).tolist()},
+            {"bufferView": 1, "componentType": componentType, "count": len(indices), "type": "SCALAR"},
+        ],
+    }
+    jsonChunk = json.dumps(gltf, separators=(',', ':')).encode('utf-8')
+    jsonChunk += b' ' * (-len(jsonChunk) % 4)
+    totalLength = 12 + 8 + len(jsonChunk) + 8 + binLength
+    buffer = bytearray(totalLength)
+    buffer[0:12] = np.array([0x46546C67, 2, totalLength], dtype='<u4').tobytes() # glTF magic, version, length
+    buffer[12:20] = np.array([len(jsonChunk), 0x4E4F534A], dtype='<u4').tobytes() # JSON chunk
+    buffer[20:20 + len(jsonChunk)] = jsonChunk
+    binStart = 20 + len(jsonChunk)
+    buffer[binStart:binStart + 8] = np.array([binLength, 0x004E4942], dtype='<u4').tobytes() # BIN chunk
+    buffer[binStart + 8:binStart + 8 + positionBytes] = positions.tobytes()
+    buffer[binStart + 8 + positionBytes:binStart + 8 + positionBytes + indexBytes] = indices.tobytes()
+    return buffer
+
+# Compact mesh format: positions quantized to 16 bit inside the bounding box, faces either implied
+# by the loft topology of a mesh type and ring count (getFaceTopology) or delta + zigzag + varint encoded
+# Files written before multi-ring lofts have a ring count of 0, which means 2 rings
+COMPACT_MAGIC = b'RFM1'
+COMPACT_TOPOLOGY_CODES = {'explicit': 0, 'curtain': 1, 'tube': 2, 'cape': 3, 'skirt': 4}
+COMPACT_HEADER_DTYPE = np.dtype([('magic', 'S4'), ('topology', 'u1'), ('rings', 'u1'), ('padding', 'u1', (2,)),
+                                 ('vertexCount', '<u4'), ('faceCount', '<u4'),
+                                 ('origin', '<f4', (3,)), ('step', '<f4', (3,))])
+
+# LEB128 encode unsigned integers (below 2**35), 7 bits per byte with the high bit marking continuation
+def encodeVarints(values):
+    values = np.asarray(values, dtype=np.uint64)
+    byteCounts = np.ones(values.shape[0], dtype=np.int64)
+    for shift in range(7, 35, 7):
+        byteCounts += values >= (np.uint64(1) << np.uint64(shift))
+    shifts = np.arange(byteCounts.max(initial=1), dtype=np.uint64) * np.uint64(7)
+    groups = ((values[:, None] >> shifts) & np.uint64(0x7F)).astype(np.uint8)
+    used = np.arange(shifts.shape[0]) < byteCounts[:, None]
+    groups[np.arange(shifts.shape[0]) < (byteCounts[:, None] - 1)] |= 0x80
+    return groups[used].tobytes()
+
+def decodeVarints(data, count):
+    if count == 0:
+        return np.zeros(0, dtype=np.uint64)
+    groups = np.frombuffer(data, dtype=np.uint8)
+    # Every byte without the continuation bit ends a value
+    ends = np.flatnonzero(groups < 0x80)[:count]
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    groups = groups[:ends[-1] + 1]
+    # Position of every byte inside its value gives its shift
+    shifts = (np.arange(groups.shape[0]) - np.repeat(starts, ends - starts + 1)).astype(np.uint64) * np.uint64(7)
+    return np.add.reduceat((groups & 0x7F).astype(np.uint64) << shifts, starts)
+
+# Find the mesh type and ring count whose loft topology produced these faces, so they do not have to be sent
+# The ring size n is read from the first face (the left end of capped types, the first bottom piece otherwise)
+def getImpliedTopology(vertices, faces):
+    if len(faces) == 0:
+        return 'explicit', 2
+    for meshType in ('curtain', 'tube', 'cape', 'skirt'):
+        n = int(faces[0, 2] if meshType in CAPPED_MESH_TYPES else faces[0, 1] - 1)
+        if n < 2 or len(vertices) % (2 * n) != 0 or not 2 <= len(vertices) // (2 * n) <= 255:
+            continue
+        template = getFaceTopology(meshType, n, len(vertices) // (2 * n))
+        if template.shape == faces.shape and np.array_equal(template, faces):
+            return meshType, len(vertices) // (2 * n)
+    return 'explicit', 2
+
+def getCompactBytes(vertices, faces):
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces = np.asarray(faces)
+    header = np.zeros(1, dtype=COMPACT_HEADER_DTYPE)
+    topology, numRings = getImpliedTopology(vertices, faces)
+    origin = vertices.min(axis=0)
+    step = (vertices.max(axis=0) - origin) / 65535.0
+    step[step == 0] = 1.0 # Flat axis, every value quantizes to 0
+    header['magic'] = COMPACT_MAGIC
+    header['topology'] = COMPACT_TOPOLOGY_CODES[topology]
+    header['rings'] = numRings
+    header['vertexCount'] = len(vertices)
+    header['faceCount'] = len(faces)
+    header['origin'] = origin
+    header['step'] = step
+    quantized = np.rint((vertices - origin) / step).astype('<u2')
+    chunks = [header.tobytes(), quantized.tobytes()]
+    if topology == 'explicit':
+        # Consecutive indices of strip meshes are close, so their zigzag encoded deltas fit in one or two bytes
+        deltas = np.diff(faces.ravel().astype(np.int64), prepend=0)
+        zigzag = (deltas << 1) ^ (deltas >> 63)
+        encoded = encodeVarints(zigzag)
+        chunks += [np.uint32(len(encoded)).astype('<u4').tobytes(), encoded]
+    return b''.join(chunks)
+
+# Decode getCompactBytes output back to float32 vertices and int32 faces
+def readCompactBytes(data):
+    header = np.frombuffer(data, dtype=COMPACT_HEADER_DTYPE, count=1)[0]
+    if header['magic'] != COMPACT_MAGIC:
+        raise ValueError("Not a compact mesh")
+    vertexCount = int(header['vertexCount'])
+    offset = COMPACT_HEADER_DTYPE.itemsize
+    quantized = np.frombuffer(data, dtype='<u2', count=vertexCount * 3, offset=offset).reshape(-1, 3)
+    vertices = (quantized * header['step'] + header['origin']).astype(MESH_VERTEX_DTYPE)
+    offset += vertexCount * 6
+    topology = {code: name for name, code in COMPACT_TOPOLOGY_CODES.items()}[int(header['topology'])]
+    if topology != 'explicit':
+        numRings = int(header['rings']) or 2
+        return vertices, np.array(getFaceTopology(topology, vertexCount // (2 * numRings), numRings))
+    encodedLength = int(np.frombuffer(data, dtype='<u4', count=1, offset=offset)[0])
+    zigzag = decodeVarints(data[offset + 4:offset + 4 + encodedLength], int(header['faceCount']) * 3).astype(np.int64)
+    deltas = (zigzag >> 1) ^ -(zigzag & 1)
+    return vertices, np.cumsum(deltas).astype(MESH_INDEX_DTYPE).reshape(-1, 3)
+
+# Serializers of every supported output format
+MESH_WRITERS = {'stl': getSTLBytes, 'ply': getPLYBytes, 'glb': getGLBBytes, 'rfm': getCompactBytes}
+
+# Write the mesh as binary STL to a file path or any writable binary file object (e.g. io.BytesIO)
+def writeSTL(vertices, faces, fileObj):
+    if isinstance(fileObj, str):
+        with open(fileObj, 'wb') as stlFile:
+            stlFile.write(getSTLBytes(vertices, faces))
+    else:
+        fileObj.write(getSTLBytes(vertices, faces))
+
+def makeSTL(vertices, faces, filename='curtain.stl', dir='.'):
     # Write the mesh to an STL file
-    generatedMesh.save(dir+"/"+filename)
+    writeSTL(vertices, faces, dir+"/"+filename)
+
+# Check that the faces form a closed, consistently wound surface: every directed edge must appear
+# exactly once and its reverse must appear exactly once. Edges are hashed into single int64 keys,
+# so the check is a couple of vectorized passes over the faces instead of building a full trimesh
+def isClosedManifold(faces, numVertices):
+    faces = np.asarray(faces, dtype=np.int64)
+    edgeStarts = faces.ravel()
+    edgeEnds = faces[:, [1, 2, 0]].ravel()
+    edgeKeys = np.sort(edgeStarts * numVertices + edgeEnds)
+    reverseKeys = np.sort(edgeEnds * numVertices + edgeStarts)
+    if np.any(edgeKeys[1:] == edgeKeys[:-1]):
+        return False # An edge is used twice in the same direction, inconsistent winding or non-manifold
+    return np.array_equal(edgeKeys, reverseKeys)
+
+# Signed volume of a closed mesh, positive when the faces are wound outwards
+def getSignedVolume(vertices, faces):
+    triangles = np.asarray(vertices)[faces]
+    return np.einsum('ij,ij->', triangles[:, 0], np.cross(triangles[:, 1], triangles[:, 2])) / 6.0
+
+# Lightweight validity check used before falling back to trimesh repair
+def isValidMesh(vertices, faces):
+    return isClosedManifold(faces, len(vertices)) and getSignedVolume(vertices, faces) > 0
 
-def verifyMesh(filename='curtain.stl', dir='.'):
+# Run the trimesh repair chain, only needed when isValidMesh fails
+def repairMesh(generatedMesh):
+    import trimesh # Heavy, only loaded when a mesh actually needs repairing or verifying
+    trimesh.repair.broken_faces(generatedMesh, color=None)
+    trimesh.repair.fill_holes(generatedMesh)
+    trimesh.repair.fix_inversion(generatedMesh, multibody=False)
+    trimesh.repair.fix_normals(generatedMesh, multibody=False)
+    trimesh.repair.fix_winding(generatedMesh)
+    return generatedMesh
+
+# Verify a generated mesh, pass the vertices and faces to skip reloading the STL when it is already valid
+def verifyMesh(filename='curtain.stl', dir='.', vertices=None, faces=None):
+    if vertices is not None and faces is not None and isValidMesh(vertices, faces):
+        print("Mesh {} is already watertight and manifold.".format(filename))
+        return
+    import trimesh
     mesh = trimesh.load(dir+"/"+filename)
     # Check for self-intersections
     if not mesh.is_watertight or not mesh.is_volume:
         print("Mesh {} is not watertight or manifold, attempting repair...".format(filename))
         # Attempt to repair the mesh
-        trimesh.repair.broken_faces(mesh, color=None)
-        trimesh.repair.fill_holes(mesh)
-        trimesh.repair.fix_inversion(mesh, multibody=False)
-        trimesh.repair.fix_normals(mesh, multibody=False)
-        trimesh.repair.fix_winding(mesh)
+        repairMesh(mesh)
         mesh.export(dir+"/"+filename)
         print("Repair attempt completed. Check '{}'.".format(filename))
     else:
@@ -234,13 +546,13 @@ def testMesh():
     plusDelta, minusDelta = testThickness(sampleHemline, thickness = 0.5)
     generatedVertices, generatedFaces = makeCurtain(plusDelta, minusDelta, height = 5)
     makeSTL(generatedVertices, generatedFaces, filename='curtain.stl', dir='.')
-    verifyMesh(filename='curtain.stl', dir='.')
+    verifyMesh(filename='curtain.stl', dir='.', vertices=generatedVertices, faces=generatedFaces)
     # Test Full Circle
     sampleHemline = np.array(testFullCircle(numFold = 20, resolution = 0.0001))
-    plusDelta, minusDelta = testThickness(sampleHemline, thickness = 0.5)
+    plusDelta, minusDelta = testThickness(sampleHemline, thickness = 0.5, closed = True)
     generatedVertices, generatedFaces = makeCurtainFullCircle(plusDelta, minusDelta, height = 5)
     makeSTL(generatedVertices, generatedFaces, filename='fullCircle.stl', dir='.')
-    verifyMesh(filename='fullCircle.stl', dir='.')
+    verifyMesh(filename='fullCircle.stl', dir='.', vertices=generatedVertices, faces=generatedFaces)
     
 def testSkirtsMesh():
     # Test skirt generation
@@ -249,19 +561,19 @@ def testSkirtsMesh():
                     minHeight=1, maxHeight=3, radius=20, numFolds=20, symmetricFold=False, 
                     randomSeed = None, uniformCircle = True)
     bottomHemline = np.array(getCurvePoints(bottomCtrlPoints, degree = 3, resolution = 0.0005))
-    bottomPlusDelta, bottomMinusDelta = thickenHemline(bottomHemline, thickness = 0.5)
+    bottomPlusDelta, bottomMinusDelta = thickenHemline(bottomHemline, thickness = 0.5, closed = True)
     topCtrlPoints, randomSeed = generateControlPointsFullCircle( \
                     minRuffleWdith=6, maxRuffleWidth=8, minBaseWdith=4, maxBaseWidth=5, \
                     minHeight=1, maxHeight=3, radius=6, numFolds=20, symmetricFold=False, 
                     randomSeed = randomSeed, uniformCircle = True)
     topHemline = np.array(getCurvePoints(topCtrlPoints, degree = 3, resolution = 0.0005))
-    topPlusDelta, topMinusDelta = thickenHemline(topHemline, thickness = 0.2)
+    topPlusDelta, topMinusDelta = thickenHemline(topHemline, thickness = 0.2, closed = True)
     generatedVertices, generatedFaces = makeSkirt(bottomOutCurve=bottomPlusDelta, \
                                                 bottomInCurve=bottomMinusDelta, \
                                                 topOutCurve=topPlusDelta, \
                                                 topInCurve=topMinusDelta, height = 35)
     makeSTL(generatedVertices, generatedFaces, filename='skirt.stl', dir='.')
-    verifyMesh(filename='skirt.stl', dir='.')
+    verifyMesh(filename='skirt.stl', dir='.', vertices=generatedVertices, faces=generatedFaces)
 
     # Test cape generation
     bottomCtrlPoints, randomSeed = generateControlPointsPolar( \
@@ -281,7 +593,82 @@ def testSkirtsMesh():
                                                 topOutCurve=topPlusDelta, \
                                                 topInCurve=topMinusDelta, height = 35)
     makeSTL(generatedVertices, generatedFaces, filename='cape.stl', dir='.')
-    verifyMesh(filename='cape.stl', dir='.')
+    verifyMesh(filename='cape.stl', dir='.', vertices=generatedVertices, faces=generatedFaces)
+
+# Thick random hemlines of a skirt or cape for the loft tests, one ring per radius from the bottom up
+# With shareFolds every ring continues the random seed of the one below it, otherwise each gets its own folds
+def getTestRings(meshType, numFolds, resolution, radii = (20, 8), thicknesses = (0.5, 0.2), shareFolds = True):
+    closed = meshType in CLOSED_MESH_TYPES
+    generateControlPoints = generateControlPointsFullCircle if closed else generateControlPointsPolar
+    rings = []
+    randomSeed = None
+    for radius, thickness in zip(radii, thicknesses):
+        ctrlPoints, seed = generateControlPoints(6, 8, 4, 5, 1, 3, radius, numFolds, False, randomSeed = randomSeed)
+        randomSeed = seed if shareFolds else None
+        rings.append(thickenHemline(getCurvePoints(ctrlPoints, 3, resolution), thickness, closed))
+    return rings
+
+# Compare the compact encoding against binary STL: size ratio, quantization error and encode/decode time
+def testCompact(numFolds = 20, resolution = 0.0005, repeats = 20):
+    import time
+    for meshType in ('skirt', 'cape'):
+        generatedVertices, generatedFaces = makeRingStack(getTestRings(meshType, numFolds, resolution), (0, 35), meshType)
+        stlBytes = getSTLBytes(generatedVertices, generatedFaces)
+        startTime = time.perf_counter()
+        for _ in range(repeats):
+            compactBytes = getCompactBytes(generatedVertices, generatedFaces)
+        encodeTime = (time.perf_counter() - startTime) / repeats
+        startTime = time.perf_counter()
+        for _ in range(repeats):
+            decodedVertices, decodedFaces = readCompactBytes(compactBytes)
+        decodeTime = (time.perf_counter() - startTime) / repeats
+        print("{}: STL {} bytes, compact {} bytes ({:.1f}x smaller), max error {:.2e}, encode {:.2f} ms, decode {:.2f} ms".format(
+            meshType, len(stlBytes), len(compactBytes), len(stlBytes) / len(compactBytes),
+            np.abs(decodedVertices - generatedVertices).max(), encodeTime * 1000, decodeTime * 1000))
+        assert np.array_equal(decodedFaces, generatedFaces)
+
+# Loft tiered skirts and capes with interpolated rings: check they stay closed and outward wound, that the
+# compact format implies their faces, and print how memory and time grow with the ring count
+def testRingStack(numFolds = 20, resolution = 0.0005, tiers = 3):
+    import time
+    for meshType in ('skirt', 'cape'):
+        radii = np.linspace(20, 6, tiers + 1)
+        rings = getTestRings(meshType, numFolds, resolution, radii, [0.5] * len(radii), shareFolds = False)
+        heights = np.linspace(0, 35, tiers + 1)
+        for ringsBetween in (0, 3, 15):
+            startTime = time.perf_counter()
+            generatedVertices, generatedFaces = makeRingStack(rings, heights, meshType, ringsBetween)
+            loftTime = time.perf_counter() - startTime
+            decodedVertices, decodedFaces = readCompactBytes(getCompactBytes(generatedVertices, generatedFaces))
+            print("{} {} tiers, {} rings between: {} rings, {} faces, {:.2f} MiB, {:.2f} ms".format(
+                meshType, tiers, ringsBetween, getRingCount(tiers + 1, ringsBetween), len(generatedFaces),
+                (generatedVertices.nbytes + generatedFaces.nbytes) / 2**20, loftTime * 1000))
+            assert isValidMesh(generatedVertices, generatedFaces)
+            assert np.array_equal(decodedFaces, generatedFaces)
+
+# Decimate a skirt and a cape to shrinking face budgets: every mesh must fit its budget, stay closed and
+# keep its loft topology
+def testDecimation(numFolds = 20, resolution = 0.0005):
+    for meshType in ('skirt', 'cape'):
+        rings = getTestRings(meshType, numFolds, resolution)
+        fullFaces = makeRingStack(rings, (0, 35), meshType)[1].shape[0]
+        for budget in (0.5, 0.2, 0.05):
+            decimatedRings, maxError = decimateRings(rings, meshType, maxFaces = int(fullFaces * budget))
+            generatedVertices, generatedFaces = makeRingStack(decimatedRings, (0, 35), meshType)
+            print("{}: {} of {} faces, max error {:.4f}".format(meshType, len(generatedFaces), fullFaces, maxError))
+            assert len(generatedFaces) <= fullFaces * budget
+            assert isValidMesh(generatedVertices, generatedFaces)
+            assert getImpliedTopology(generatedVertices, generatedFaces)[0] != 'explicit'
+        # Budgets that could only be met by folding the hemlines over themselves are refused, not turned inside out
+        for maxFaces in (40, 100, 300):
+            try:
+                decimatedRings, maxError = decimateRings(rings, meshType, maxFaces = maxFaces)
+            except ValueError as error:
+                print("{}: {} faces refused, {}".format(meshType, maxFaces, error))
+                continue
+            generatedVertices, generatedFaces = makeRingStack(decimatedRings, (0, 35), meshType)
+            assert len(generatedFaces) <= maxFaces
+            assert isValidMesh(generatedVertices, generatedFaces)
 
 if __name__ == "__main__":
     #testMesh()
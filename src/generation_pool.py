@@ -0,0 +1,183 @@
+# Run CPU-bound mesh generation in worker processes so requests are not serialized by the GIL
+# The pool keeps a bounded number of jobs in flight, applies a per-job timeout to the time a job runs (not
+# the time it waits behind other jobs) and drops jobs whose client went away before they started. A job running past its timeout can not be cancelled
+# inside its worker, so the worker process is terminated and replaced instead
+# Every worker has its own single process executor (a lane), so jobs sharing the upstream stages of the
+# pipeline (an affinity key, e.g. the same hemline with a new height) go to the worker whose stage caches
+# already hold them, unless another worker has fewer jobs in flight
+import asyncio, multiprocessing, threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+class PoolBusyError(Exception):
+    pass
+
+# A worker process died (crash, out of memory or terminated after a timeout), the pool is restarted
+class WorkerLostError(PoolBusyError):
+    pass
+
+class JobTimeoutError(Exception):
+    pass
+
+class ClientDisconnectedError(Exception):
+    pass
+
+# Import the generation modules and fill the per-process caches before the first real job arrives
+def warmWorker():
+    import helper
+    helper.generateMesh('curtain', 1, 0.1, 0.3, 0.1, 0.3, 0.1, 0.3, 0.3, 0.5, 0.01, False, 0)
+    return True
+
+class GenerationPool:
+    # maxWorkers = 0 runs jobs in a thread of the server process instead (useful for debugging)
+    def __init__(self, maxWorkers = None, maxQueue = 32, timeout = 30.0, pollInterval = 0.1):
+        self.maxWorkers = maxWorkers if maxWorkers is not None else multiprocessing.cpu_count()
+        self.maxQueue = maxQueue
+        self.timeout = timeout
+        self.pollInterval = pollInterval
+        self.executors = [None] * self.maxWorkers # One single worker executor per lane
+        self.lanePending = [0] * self.maxWorkers
+        self.laneJobs = [deque() for _ in range(self.maxWorkers)] # Futures submitted to each lane, oldest first
+        self.pending = 0
+        self.lock = threading.Lock()
+
+    def getExecutor(self, lane = 0):
+        with self.lock:
+            if self.maxWorkers == 0:
+                return None
+            if self.executors[lane] is None:
+                # Spawn instead of fork, forking a process running an event loop and threads is not safe
+                self.executors[lane] = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+            return self.executors[lane]
+
+    # Submit a job to the executor of a lane, remembering the order the lane's single worker runs them in
+    def submit(self, lane, executor, func, *args):
+        with self.lock:
+            jobFuture = executor.submit(func, *args)
+            self.laneJobs[lane].append(jobFuture)
+        return jobFuture
+
+    # Whether the worker of a lane started jobFuture: every job submitted to the lane before it is done
+    # (Future.running() can not tell, the executor marks the next queued job as running ahead of time)
+    def hasStarted(self, lane, jobFuture):
+        with self.lock:
+            jobs = self.pruneLane(lane)
+            return not jobs or jobs[0] is jobFuture
+
+    # Drop the finished jobs at the front of a lane (and their results), called with the lock held
+    def pruneLane(self, lane):
+        jobs = self.laneJobs[lane]
+        while jobs and jobs[0].done():
+            jobs.popleft()
+        return jobs
+
+    # Start every worker process and warm it up
+    def warm(self):
+        futures = [self.submit(lane, self.getExecutor(lane), warmWorker) for lane in range(self.maxWorkers)]
+        for future in futures:
+            future.result()
+
+    def shutdown(self):
+        with self.lock:
+            executors, self.executors = self.executors, [None] * self.maxWorkers
+        for executor in executors:
+            if executor is not None:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+    # Terminate the worker process of a lane and start a new one, unless another job already did
+    # Every other job queued on the lane fails with WorkerLostError
+    def restart(self, lane, executor):
+        with self.lock:
+            if executor is None or self.executors[lane] is not executor:
+                return
+            self.executors[lane] = None
+            self.laneJobs[lane] = deque()
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+        self.submit(lane, self.getExecutor(lane), warmWorker) # Warm up in the background, do not wait for it
+
+    # The lane of the worker whose caches hold the affinity key, or the least busy one, called with the lock held
+    def chooseLane(self, affinity):
+        leastBusy = min(range(self.maxWorkers), key=self.lanePending.__getitem__)
+        if affinity is None:
+            return leastBusy
+        lane = hash(affinity) % self.maxWorkers
+        # Never queue behind a busier worker while a less busy one could start the job, cached stages are
+        # only worth it when the affine worker is as free as any other
+        if self.lanePending[lane] > self.lanePending[leastBusy]:
+            return leastBusy
+        return lane
+
+    # Run func(*args) in the pool and wait for the result
+    # isDisconnected: optional coroutine function, polled while waiting, the job is cancelled when it returns True
+    # affinity: optional hashable key, jobs with the same key run in the same worker when it is not overloaded
+    async def run(self, func, *args, isDisconnected = None, affinity = None):
+        with self.lock:
+            if self.pending >= self.maxQueue:
+                raise PoolBusyError("Too many generation jobs in flight")
+            self.pending += 1
+            lane = self.chooseLane(affinity) if self.maxWorkers > 0 else None
+            if lane is not None:
+                self.lanePending[lane] += 1
+        try:
+            loop = asyncio.get_running_loop()
+            executor = self.getExecutor(lane) if lane is not None else None
+            if executor is None:
+                jobFuture = None # Thread of the server process, it can not be stopped once it runs
+                future = loop.run_in_executor(None, func, *args)
+            else:
+                try:
+                    jobFuture = self.submit(lane, executor, func, *args)
+                except (BrokenProcessPool, RuntimeError): # Broken, or shut down by a concurrent restart
+                    self.restart(lane, executor)
+                    raise WorkerLostError("The generation workers were restarting, try again")
+                future = asyncio.wrap_future(jobFuture)
+            # The timeout counts from the moment the worker picks the job up, a thread job starts right away
+            deadline = loop.time() + self.timeout if jobFuture is None else None
+            while True:
+                if deadline is None and self.hasStarted(lane, jobFuture):
+                    deadline = loop.time() + self.timeout
+                remaining = deadline - loop.time() if deadline is not None else self.pollInterval
+                if remaining <= 0:
+                    if jobFuture is not None and not jobFuture.cancel():
+                        self.restart(lane, executor) # Already running, stop its worker so it does not stay busy
+                    future.cancel()
+                    raise JobTimeoutError("Generation took longer than {} seconds".format(self.timeout))
+                done, _ = await asyncio.wait({future}, timeout=min(self.pollInterval, remaining))
+                if done:
+                    if future.cancelled(): # Dropped from the queue when its worker was restarted
+                        raise WorkerLostError("The generation worker was restarted, try again")
+                    try:
+                        return future.result()
+                    except BrokenProcessPool:
+                        self.restart(lane, executor)
+                        raise WorkerLostError("A generation worker died, try again")
+                if isDisconnected is not None and await isDisconnected():
+                    # Only jobs still waiting in the queue can be cancelled, a running job finishes in its worker
+                    future.cancel()
+                    raise ClientDisconnectedError("Client disconnected")
+        except asyncio.CancelledError:
+            future.cancel() # The caller gave up, drop the job if it has not started yet
+            raise
+        finally:
+            with self.lock:
+                self.pending -= 1
+                if lane is not None:
+                    self.lanePending[lane] -= 1
+                    self.pruneLane(lane)
+
+# Concurrent jobs with distinct affinity keys must fan out over every worker, and a repeated key must go back
+# to its worker while the pool is idle. Only the lane choice is checked, no worker process is started
+def testLaneChoice(numWorkers = 4, rounds = 200):
+    pool = GenerationPool(maxWorkers = numWorkers)
+    for round in range(rounds):
+        lanes = []
+        for job in range(numWorkers):
+            lane = pool.chooseLane(('skirt', round, job))
+            pool.lanePending[lane] += 1
+            lanes.append(lane)
+        assert sorted(lanes) == list(range(numWorkers)), lanes
+        pool.lanePending = [0] * numWorkers
+    assert len({pool.chooseLane(('skirt', 42)) for _ in range(10)}) == 1
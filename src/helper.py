@@ -1,40 +1,334 @@
 # Helper functions for main to aggregate functionalities of other scripts
+import os, random, threading, time, tracemalloc
 import numpy as np
-from stl import mesh
-import trimesh
 
-from src.hemline_bspline import generateControlPointsFullCircle, generateControlPointsPolar, getCurvePoints, testCartesian, testPolar, testFullCircle
-from src.create_mesh import makeSkirt
-from src.hemline_thickness import thickenHemline
+# trimesh is only imported where a mesh is repaired or wrapped, generation workers never load it otherwise
+from hemline_bspline import generateControlPointsCartesian, generateControlPointsFullCircle, generateControlPointsPolar, getCurvePoints, getSampleParams, getAdaptiveResolution
+from create_mesh import makeCurtain, makeCurtainFullCircle, makeRingStack, getRingCount, decimateRings, isValidMesh, repairMesh, MeshBuffers, MESH_WRITERS
+from hemline_thickness import thickenHemline
+from stage_cache import StageCache, getValueBytes
+from metrics import measureSpan
+
+# The top hemline of capes and skirts is a smaller copy of the bottom one (same seed)
+TOP_RADIUS_RATIO = {'cape': 0.5, 'skirt': 0.3}
+TOP_THICKNESS_RATIO = 0.4
+
+# Mesh types built from closed (full circle) hemlines
+CLOSED_HEMLINE_TYPES = ('tube', 'skirt')
+
+# Most rings a mesh may be lofted from (tier hemlines plus interpolated rings), memory grows linearly with it
+MAX_LOFT_RINGS = 128
+
+# Per-process caches of the pipeline stages, RUFFLE_STAGE_CACHE_BYTES is the budget of each stage
+PIPELINE_STAGES = ('controlPoints', 'curves', 'thicken', 'decimate', 'loft')
+STAGE_CACHE_BYTES = int(os.environ.get('RUFFLE_STAGE_CACHE_BYTES', 16 * 1024 * 1024))
+STAGE_CACHES = {stage: StageCache(STAGE_CACHE_BYTES) for stage in PIPELINE_STAGES}
+
+def getStageCacheStats():
+    return {stage: cache.stats() for stage, cache in STAGE_CACHES.items()}
+
+# Generation pipeline carrying its own seed, random generators and configuration from control points
+# to getCurvePoints, thickenHemline and the make* builders. Nothing touches the module-global random
+# state, so engines can run in parallel threads or processes and give bit-identical results per seed
+class GenerationEngine:
+    def __init__(self, randomSeed = None, degree = 3, sampling = 'uniform', \
+                 topRadiusRatio = TOP_RADIUS_RATIO, topThicknessRatio = TOP_THICKNESS_RATIO, stageCaches = STAGE_CACHES, \
+                 spans = None, meshBuffers = None, periodic = False, tiers = 1, ringsBetween = 0, \
+                 maxFaces = None, tolerance = 0.0, maxAngle = None):
+        if randomSeed is None:
+            randomSeed = random.SystemRandom().randint(0, 2**32 - 1)
+        self.randomSeed = int(randomSeed)
+        self.degree = degree
+        self.sampling = sampling
+        self.topRadiusRatio = topRadiusRatio
+        self.topThicknessRatio = topThicknessRatio
+        self.stageCaches = stageCaches # None disables the stage caches
+        self.spans = spans # List collecting a timing span per stage, see metrics.measureSpan
+        self.meshBuffers = meshBuffers # Optional create_mesh.MeshBuffers the loft writes into
+        self.periodic = periodic # Closed hemlines (tube, skirt) as periodic instead of clamped B-splines
+        self.tiers = tiers # Ruffled hemlines of capes and skirts stacked from the bottom to the top hemline
+        self.ringsBetween = ringsBetween # Rings interpolated between every pair of lofted hemlines
+        self.maxFaces = maxFaces # Face budget the hemlines are simplified down to, None keeps every sample
+        self.tolerance = tolerance # Hemline samples that move the hemlines by at most this much are dropped
+        self.maxAngle = maxAngle # Largest hemline turn between samples (degrees), picks the resolution, see getHemlines
+
+    # Every hemline of a mesh starts from the same seed, so the top hemline is a copy of the bottom one
+    # The hemlines of the upper tiers get their own folds from a seed derived from the mesh seed
+    def getRng(self, tier = 0):
+        if tier == 0:
+            return random.Random(self.randomSeed)
+        return random.Random('{}/{}'.format(self.randomSeed, tier))
+
+    def getControlPoints(self, meshType, numFolds, minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, \
+                         minHeight, maxHeight, radius, symmetricFold, periodic = False, tier = 0):
+        if meshType == 'curtain':
+            result = generateControlPointsCartesian(minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, \
+                                                    minHeight, maxHeight, numFolds, symmetricFold, rng = self.getRng(tier))
+        elif meshType == 'cape':
+            result = generateControlPointsPolar(minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, \
+                                                minHeight, maxHeight, radius, numFolds, symmetricFold, rng = self.getRng(tier))
+        else:
+            result = generateControlPointsFullCircle(minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, \
+                                                     minHeight, maxHeight, radius, numFolds, symmetricFold, \
+                                                     uniformCircle = True, rng = self.getRng(tier), periodic = periodic)
+        if not result:
+            raise ValueError("Invalid hemline parameters for mesh type '{}'".format(meshType))
+        return result[0]
+
+    # Run one pipeline stage through its cache, or directly when caching is disabled
+    def runStage(self, stage, key, compute):
+        with measureSpan(self.spans, stage) as span:
+            if self.stageCaches is None:
+                result = compute()
+            else:
+                result = self.stageCaches[stage].get(key, compute)
+            span['resultBytes'] = getValueBytes(result)
+        return result
+
+    # Stage 1: control points of the bottom hemline and, for capes and skirts, of the top hemline
+    # With several tiers the hemlines of the tiers in between shrink linearly from the bottom to the top radius
+    def getControlPointSets(self, meshType, foldParams, radius, symmetricFold, periodic = False):
+        topRadiusRatio = self.topRadiusRatio.get(meshType)
+        tiers = self.tiers if topRadiusRatio is not None else 1
+        key = (meshType, self.randomSeed, foldParams, radius, symmetricFold, topRadiusRatio, periodic, tiers)
+        def compute():
+            ctrlPointSets = [np.asarray(self.getControlPoints(meshType, *foldParams, radius, symmetricFold, periodic), \
+                                        dtype=float)]
+            if topRadiusRatio is not None:
+                tierRadii = np.linspace(radius, radius * topRadiusRatio, tiers + 1)
+                for tier in range(1, tiers + 1):
+                    ctrlPointSets.append(np.asarray(self.getControlPoints(meshType, *foldParams, float(tierRadii[tier]), \
+                                                                          symmetricFold, periodic, tier % tiers), \
+                                                    dtype=float))
+            return tuple(ctrlPointSets)
+        return key, self.runStage('controlPoints', key, compute)
+
+    # Stage 2: evaluate every hemline at the same sample parameters so the points line up for lofting
+    # Periodic hemlines are closed loops without a seam point. With maxAngle the hemlines are curvature
+    # sampled at the coarsest resolution keeping every turn below it (see getAdaptiveResolution), not resolution
+    def getHemlines(self, ctrlKey, ctrlPointSets, resolution, periodic = False):
+        sampling = 'curvature' if self.maxAngle is not None else self.sampling
+        key = (ctrlKey, self.degree, sampling, resolution if self.maxAngle is None else None, periodic, self.maxAngle)
+        def compute():
+            curveResolution = resolution
+            if self.maxAngle is not None:
+                curveResolution = getAdaptiveResolution(ctrlPointSets, self.degree, self.maxAngle, periodic = periodic)
+            sampleParams = getSampleParams(ctrlPointSets, degree = self.degree, resolution = curveResolution, \
+                                           sampling = sampling, periodic = periodic)
+            return tuple(getCurvePoints(ctrlPoints, degree = self.degree, resolution = curveResolution, params = sampleParams, \
+                                        periodic = periodic) for ctrlPoints in ctrlPointSets)
+        return key, self.runStage('curves', key, compute)
+
+    # Stage 3: offset every hemline to both sides, the thickness shrinks from the bottom to the top hemline
+    def getThickHemlines(self, curveKey, hemlines, thickness, closed):
+        key = (curveKey, thickness, self.topThicknessRatio, closed)
+        def compute():
+            ratios = np.linspace(1.0, self.topThicknessRatio, len(hemlines))
+            return tuple(thickenHemline(hemline, thickness = thickness * float(ratio), closed = closed) \
+                         for hemline, ratio in zip(hemlines, ratios))
+        return key, self.runStage('thicken', key, compute)
+
+    # Rings the thick hemlines are lofted from, curtains and tubes loft their single hemline onto itself
+    def getLoftRingCount(self, meshType, thickHemlines):
+        numRings = getRingCount(len(thickHemlines) if meshType in self.topRadiusRatio else 2, self.ringsBetween)
+        if self.tiers < 1 or self.ringsBetween < 0 or numRings > MAX_LOFT_RINGS:
+            raise ValueError("Invalid tiers or ringsBetween, a mesh is lofted from at most {} rings".format(MAX_LOFT_RINGS))
+        return numRings
+
+    # Stage 4: drop the samples of nearly straight hemline stretches until the mesh fits in maxFaces and no
+    # sample moves the hemlines by at most tolerance, fold crests and hems are kept (see decimateRings)
+    # Skipped without maxFaces or tolerance, so the undecimated mesh is exactly the same as before
+    def decimateHemlines(self, meshType, thickKey, thickHemlines):
+        if self.maxFaces is None and not self.tolerance > 0:
+            return thickKey, thickHemlines
+        numRings = self.getLoftRingCount(meshType, thickHemlines)
+        key = (thickKey, meshType, self.maxFaces, self.tolerance, numRings)
+        def compute():
+            return tuple(decimateRings(thickHemlines, meshType, self.maxFaces, self.tolerance, numRings)[0])
+        return key, self.runStage('decimate', key, compute)
+
+    # Stage 5: loft the thick hemlines into the float32 vertices and int32 faces of the mesh
+    # The hemlines of capes and skirts are stacked at equal height steps from the bottom to the top
+    # With meshBuffers the vertices are written into the reused buffers, so this stage is not cached
+    def loftMesh(self, meshType, thickKey, thickHemlines, height):
+        key = (thickKey, height, self.ringsBetween)
+        self.getLoftRingCount(meshType, thickHemlines)
+        def compute():
+            (bottomPlusDelta, bottomMinusDelta) = thickHemlines[0]
+            if meshType == 'curtain':
+                return makeCurtain(bottomPlusDelta, bottomMinusDelta, height = height, out = self.meshBuffers, \
+                                   ringsBetween = self.ringsBetween)
+            if meshType == 'tube':
+                return makeCurtainFullCircle(bottomPlusDelta, bottomMinusDelta, height = height, out = self.meshBuffers, \
+                                             ringsBetween = self.ringsBetween)
+            heights = np.linspace(0, height, len(thickHemlines))
+            return makeRingStack(thickHemlines, heights, meshType, self.ringsBetween, out = self.meshBuffers)
+        if self.meshBuffers is not None:
+            with measureSpan(self.spans, 'loft') as span:
+                result = compute()
+                span['resultBytes'] = getValueBytes(result)
+            return result
+        return self.runStage('loft', key, compute)
+
+    # Generate the vertices and faces of one mesh type from the web app parameters
+    # curtain: straight hemline, tube: full circle hemline, cape: open circle hemline lofted to a smaller one,
+    # skirt: full circle hemline lofted to a smaller one. Raises ValueError for invalid parameters
+    # Capes and skirts with tiers > 1 stack one ruffled hemline per tier between the bottom and the top one
+    # maxFaces and tolerance simplify the hemlines before lofting, see decimateHemlines, maxAngle picks the resolution
+    # Each stage is cached on its own inputs, a height-only change only lofts again and a thickness-only
+    # change only thickens and lofts again. The returned arrays are read-only when caching is enabled
+    def generateMesh(self, meshType, numFolds, minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, \
+                     minHeight, maxHeight, radius, thickness, resolution, symmetricFold, height = 5):
+        foldParams = (numFolds, minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, minHeight, maxHeight)
+        periodic = self.periodic and meshType in CLOSED_HEMLINE_TYPES
+        ctrlKey, ctrlPointSets = self.getControlPointSets(meshType, foldParams, radius, symmetricFold, periodic)
+        curveKey, hemlines = self.getHemlines(ctrlKey, ctrlPointSets, resolution, periodic)
+        thickKey, thickHemlines = self.getThickHemlines(curveKey, hemlines, thickness, meshType in CLOSED_HEMLINE_TYPES)
+        thickKey, thickHemlines = self.decimateHemlines(meshType, thickKey, thickHemlines)
+        return self.loftMesh(meshType, thickKey, thickHemlines, height)
+
+    # Generate the mesh and serialize it in one of the MESH_WRITERS formats ('stl', 'ply' or 'glb')
+    def generateFile(self, meshFormat, *args, **kwargs):
+        vertices, faces = self.generateMesh(*args, **kwargs)
+        return bytes(MESH_WRITERS[meshFormat](vertices, faces))
+
+    def generateSTL(self, *args, **kwargs):
+        return self.generateFile('stl', *args, **kwargs)
+
+# Generate the vertices and faces of one mesh type from the web app parameters, see GenerationEngine.generateMesh
+def generateMesh(meshType, numFolds, minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, \
+                 minHeight, maxHeight, radius, thickness, resolution, symmetricFold, randomSeed, height = 5, \
+                 sampling = 'uniform', periodic = False, tiers = 1, ringsBetween = 0, maxFaces = None, tolerance = 0.0, \
+                 maxAngle = None):
+    return GenerationEngine(randomSeed, sampling = sampling, periodic = periodic, tiers = tiers, \
+                            ringsBetween = ringsBetween, maxFaces = maxFaces, tolerance = tolerance, \
+                            maxAngle = maxAngle).generateMesh(meshType, numFolds, \
+                                                     minRuffleWidth, maxRuffleWidth, \
+                                                     minBaseWidth, maxBaseWidth, minHeight, maxHeight, radius, \
+                                                     thickness, resolution, symmetricFold, height = height)
+
+# Generate one mesh and serialize it, the entry point of generation worker processes
+def generateMeshFile(meshType, numFolds, minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, \
+                     minHeight, maxHeight, radius, thickness, resolution, symmetricFold, randomSeed, height = 5, \
+                     sampling = 'uniform', meshFormat = 'stl', periodic = False, tiers = 1, ringsBetween = 0, \
+                     maxFaces = None, tolerance = 0.0, maxAngle = None):
+    return GenerationEngine(randomSeed, sampling = sampling, periodic = periodic, tiers = tiers, \
+                            ringsBetween = ringsBetween, maxFaces = maxFaces, \
+                            tolerance = tolerance, maxAngle = maxAngle).generateFile(meshFormat, meshType, numFolds, \
+                                                                         minRuffleWidth, maxRuffleWidth, \
+                                                                         minBaseWidth, maxBaseWidth, minHeight, \
+                                                                         maxHeight, radius, thickness, resolution, \
+                                                                         symmetricFold, height = height)
+
+# Vertex buffers reused by every mesh serialized in this thread (each worker process or pool thread)
+workerState = threading.local()
+
+def getWorkerMeshBuffers():
+    if not hasattr(workerState, 'meshBuffers'):
+        workerState.meshBuffers = MeshBuffers()
+    return workerState.meshBuffers
+
+# Generate and serialize one mesh like generateMeshFile, also returning the timing spans of every stage and
+# the mesh size for the /metrics endpoint. useStageCaches = False runs every stage (used when profiling).
+# With repair the mesh is validated and run through the trimesh repair when it is not a closed, outward
+# wound surface. RUFFLE_TRACE_MEMORY=1 adds the peak allocation of every
+# stage, tracemalloc slows generation down a lot so it is off by default
+# The vertices are lofted into the per-thread worker buffers, they only have to live until serialized
+def generateMeshFileTraced(meshType, numFolds, minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, \
+                           minHeight, maxHeight, radius, thickness, resolution, symmetricFold, randomSeed, height = 5, \
+                           sampling = 'uniform', meshFormat = 'stl', repair = False, useStageCaches = True, \
+                           periodic = False, tiers = 1, ringsBetween = 0, maxFaces = None, tolerance = 0.0, \
+                           maxAngle = None):
+    if os.environ.get('RUFFLE_TRACE_MEMORY') == '1' and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    spans = []
+    engine = GenerationEngine(randomSeed, sampling = sampling, spans = spans, \
+                              stageCaches = STAGE_CACHES if useStageCaches else None, meshBuffers = getWorkerMeshBuffers(), \
+                              periodic = periodic, tiers = tiers, ringsBetween = ringsBetween, maxFaces = maxFaces, \
+                              tolerance = tolerance, maxAngle = maxAngle)
+    vertices, faces = engine.generateMesh(meshType, numFolds, minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, \
+                                          minHeight, maxHeight, radius, thickness, resolution, symmetricFold, height = height)
+    repaired = False
+    if repair:
+        with measureSpan(spans, 'validate'):
+            valid = isValidMesh(vertices, faces)
+        if not valid:
+            with measureSpan(spans, 'repair'):
+                import trimesh
+                repairedMesh = repairMesh(trimesh.Trimesh(vertices=vertices, faces=faces, process=True))
+                vertices, faces = repairedMesh.vertices, repairedMesh.faces
+            repaired = True
+    with measureSpan(spans, 'serialize') as span:
+        data = bytes(MESH_WRITERS[meshFormat](vertices, faces))
+        span['resultBytes'] = len(data)
+    return data, {'spans': spans, 'vertices': len(vertices), 'faces': len(faces), 'repaired': repaired}
+
+# Generate one mesh and serialize it as binary STL
+def generateSTL(meshType, numFolds, minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, \
+                minHeight, maxHeight, radius, thickness, resolution, symmetricFold, randomSeed, height = 5, \
+                sampling = 'uniform', periodic = False, tiers = 1, ringsBetween = 0, maxFaces = None, tolerance = 0.0, \
+                maxAngle = None):
+    return generateMeshFile(meshType, numFolds, minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, \
+                            minHeight, maxHeight, radius, thickness, resolution, symmetricFold, randomSeed, \
+                            height = height, sampling = sampling, meshFormat = 'stl', periodic = periodic, \
+                            tiers = tiers, ringsBetween = ringsBetween, maxFaces = maxFaces, tolerance = tolerance, \
+                            maxAngle = maxAngle)
+
+# Check that concurrent generation gives the same bytes as serial generation for every seed
+def testDeterminism(numSeeds = 16, meshType = 'skirt', resolution = 0.0005, workers = 4):
+    from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+    params = (meshType, 20, 6, 8, 4, 5, 1, 3, 20, 0.5, resolution, False)
+    seeds = list(range(numSeeds))
+    serial = [generateSTL(*params, seed) for seed in seeds]
+    for executorType in (ThreadPoolExecutor, ProcessPoolExecutor):
+        with executorType(max_workers=workers) as executor:
+            concurrent = list(executor.map(generateSTL, *zip(*[params + (seed,) for seed in seeds])))
+        mismatches = [seed for seed, expected, result in zip(seeds, serial, concurrent) if expected != result]
+        print("{}: {} seeds, {} mismatches".format(executorType.__name__, numSeeds, len(mismatches)))
+        assert not mismatches, "Seeds {} differ from serial generation".format(mismatches)
+    # Different seeds must still give different meshes
+    assert len(set(serial)) == numSeeds
+    return True
 
 # Skirt generation
-def generateSkirt():
-    bottomCtrlPoints, randomSeed = generateControlPointsFullCircle( \
-                    minRuffleWdith=6, maxRuffleWidth=8, minBaseWdith=4, maxBaseWidth=5, \
-                    minHeight=1, maxHeight=3, radius=20, numFolds=20, symmetricFold=False, 
-                    randomSeed = None, uniformCircle = True)
-    bottomHemline = np.array(getCurvePoints(bottomCtrlPoints, degree = 3, resolution = 0.0005))
-    bottomPlusDelta, bottomMinusDelta = thickenHemline(bottomHemline, thickness = 0.5)
-    topCtrlPoints, randomSeed = generateControlPointsFullCircle( \
-                    minRuffleWdith=6, maxRuffleWidth=8, minBaseWdith=4, maxBaseWidth=5, \
-                    minHeight=1, maxHeight=3, radius=6, numFolds=20, symmetricFold=False, 
-                    randomSeed = randomSeed, uniformCircle = True)
-    topHemline = np.array(getCurvePoints(topCtrlPoints, degree = 3, resolution = 0.0005))
-    topPlusDelta, topMinusDelta = thickenHemline(topHemline, thickness = 0.2)
-    generatedVertices, generatedFaces = makeSkirt(bottomOutCurve=bottomPlusDelta, \
-                                                bottomInCurve=bottomMinusDelta, \
-                                                topOutCurve=topPlusDelta, \
-                                                topInCurve=topMinusDelta, height = 35)
-   
-    # Create the mesh
+# sampling: 'uniform', 'arclength' or 'curvature', see getSampleParams
+# Runs through the stage caches, so calling it again with only a new thickness or height skips the upstream stages
+def generateSkirt(resolution = 0.0005, sampling = 'uniform', thickness = 0.5, height = 35, randomSeed = None):
+    engine = GenerationEngine(randomSeed, sampling = sampling)
+    import trimesh
+    generatedVertices, generatedFaces = engine.generateMesh('skirt', 20, 6, 8, 4, 5, 1, 3, 20, thickness, resolution, \
+                                                            False, height = height)
+
+    # The builders emit closed, outward wound meshes, so trimesh only has to process and repair as a fallback
+    if isValidMesh(generatedVertices, generatedFaces):
+        return trimesh.Trimesh(vertices=generatedVertices, faces=generatedFaces, process=False)
     generatedMesh = trimesh.Trimesh(vertices=generatedVertices, faces=generatedFaces, process=True)
     # Check for mesh validity
     if not generatedMesh.is_watertight or not generatedMesh.is_volume:
         # Attempt to repair the mesh
-        trimesh.repair.broken_faces(generatedMesh, color=None)
-        trimesh.repair.fill_holes(generatedMesh)
-        trimesh.repair.fix_inversion(generatedMesh, multibody=False)
-        trimesh.repair.fix_normals(generatedMesh, multibody=False)
-        trimesh.repair.fix_winding(generatedMesh)
+        repairMesh(generatedMesh)
     
-    return generatedMesh
\ No newline at end of file
+    return generatedMesh
+
+# Time a full skirt generation against height-only and thickness-only edits and check the cached
+# results match an uncached run
+def testStageCache(resolution = 0.0005, randomSeed = 1):
+    for cache in STAGE_CACHES.values():
+        cache.clear()
+    params = ['skirt', 20, 6, 8, 4, 5, 1, 3, 20, 0.5, resolution, False]
+    engine = GenerationEngine(randomSeed)
+    for label, thickness, height in (('full', 0.5, 35), ('height only', 0.5, 30), ('thickness only', 0.4, 30), \
+                                     ('repeat', 0.4, 30)):
+        params[9] = thickness
+        start = time.perf_counter()
+        vertices, faces = engine.generateMesh(*params, height = height)
+        elapsed = time.perf_counter() - start
+        expected = GenerationEngine(randomSeed, stageCaches = None).generateMesh(*params, height = height)
+        assert np.array_equal(vertices, expected[0]) and np.array_equal(faces, expected[1])
+        print("{}: {:.2f} ms".format(label, elapsed * 1000))
+    print(getStageCacheStats())
+    return True
+
+if __name__ == "__main__":
+    testDeterminism()
+    testStageCache()
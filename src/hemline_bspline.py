@@ -14,24 +14,33 @@ symmetricFold, generate only symmetric folds if set to True.
 '''
 
 # Necessary Imports
-from geomdl import BSpline
-import geomdl
-from geomdl.visualization import VisMPL
 import random, math # To generate random set of numbers and convert coordinate
+from functools import lru_cache # Cache the basis for repeated (degree, count, resolution) requests
+import numpy as np
+
+# geomdl (and matplotlib through its visualization module) is only used by the test* plotting helpers,
+# the curves themselves are evaluated with NumPy, so it is imported on first use instead of at startup
+def importGeomdl():
+    import geomdl.knotvector
+    from geomdl import BSpline
+    from geomdl.visualization import VisMPL
+    return geomdl, BSpline, VisMPL
 
 # Generate the control points in cartesian coordinate (straight line)
 def generateControlPointsCartesian(minRuffleWdith, maxRuffleWidth, minBaseWdith, maxBaseWidth,\
                                     # minDist, maxDist, \ Do not use base point system
                                     minHeight, maxHeight, \
                                     numFolds, symmetricFold, \
-                                    randomSeed=None): # Added controlled random
+                                    randomSeed=None, rng=None): # Added controlled random
     
-    # If no seed is given, generate one
-    if randomSeed is None:
-        randomSeed = random.SystemRandom().randint(0, 2**32 - 1)
+    # Use the caller's random generator if given, it must not be shared between threads
+    if rng is None:
+        # If no seed is given, generate one
+        if randomSeed is None:
+            randomSeed = random.SystemRandom().randint(0, 2**32 - 1)
 
-    # Set up controlled randomness, force it to be an int value
-    rng = random.Random(int(randomSeed))
+        # Set up controlled randomness, force it to be an int value
+        rng = random.Random(int(randomSeed))
 
     numFolds = int(numFolds) # Force conversion of numFolds
     symmetricFold = bool(symmetricFold) # Force conversion of symmetricFold boolean
@@ -92,6 +101,7 @@ def generateControlPointsCartesian(minRuffleWdith, maxRuffleWidth, minBaseWdith,
 
 def testCartesian(numFold = 4, degree = 3, resolution = 0.5):
     # Create a 3-dimensional B-spline Curve
+    geomdl, BSpline, VisMPL = importGeomdl()
     curve = BSpline.Curve()
     # Set degrees
     curve.degree = degree
@@ -122,14 +132,16 @@ def testCartesian(numFold = 4, degree = 3, resolution = 0.5):
 # All widths here are treated as degree angles instead
 def generateControlPointsPolar(minRuffleWdith, maxRuffleWidth, minBaseWdith, maxBaseWidth, \
                                minHeight, maxHeight, radius, numFolds, symmetricFold, 
-                               randomSeed=None): # Added controlled random
+                               randomSeed=None, rng=None): # Added controlled random
     
-    # If no seed is given, generate one
-    if randomSeed is None:
-        randomSeed = random.SystemRandom().randint(0, 2**32 - 1)
+    # Use the caller's random generator if given, it must not be shared between threads
+    if rng is None:
+        # If no seed is given, generate one
+        if randomSeed is None:
+            randomSeed = random.SystemRandom().randint(0, 2**32 - 1)
 
-    # Set up controlled randomness, force it to be an int value
-    rng = random.Random(int(randomSeed))
+        # Set up controlled randomness, force it to be an int value
+        rng = random.Random(int(randomSeed))
 
     numFolds = int(numFolds) # Force conversion of numFolds
     symmetricFold = bool(symmetricFold) # Force conversion of symmetricFold boolean
@@ -203,6 +215,7 @@ def generateControlPointsPolar(minRuffleWdith, maxRuffleWidth, minBaseWdith, max
 
 def testPolar(numFold = 4, degree = 3, radius = 20, resolution = 0.5):
     # Create a 3-dimensional B-spline Curve
+    geomdl, BSpline, VisMPL = importGeomdl()
     curve = BSpline.Curve()
     # Set degrees
     curve.degree = degree
@@ -234,14 +247,18 @@ def testPolar(numFold = 4, degree = 3, radius = 20, resolution = 0.5):
 # All widths here are treated as degree angles instead
 def generateControlPointsFullCircle(minRuffleWdith, maxRuffleWidth, minBaseWdith, maxBaseWidth, \
                                     minHeight, maxHeight, radius, numFolds, symmetricFold, 
-                                    randomSeed = None, uniformCircle = False): # Added controlled random
+                                    randomSeed = None, uniformCircle = False, rng = None, periodic = False): # Added controlled random
+    # periodic: return the loop of control points for a periodic curve, without the repeated
+    # first point and the end smoothing needed by a clamped curve (same random folds for a seed)
     
-    # If no seed is given, generate one
-    if randomSeed is None:
-        randomSeed = random.SystemRandom().randint(0, 2**32 - 1)
+    # Use the caller's random generator if given, it must not be shared between threads
+    if rng is None:
+        # If no seed is given, generate one
+        if randomSeed is None:
+            randomSeed = random.SystemRandom().randint(0, 2**32 - 1)
 
-    # Set up controlled randomness, force it to be an int value
-    rng = random.Random(int(randomSeed))
+        # Set up controlled randomness, force it to be an int value
+        rng = random.Random(int(randomSeed))
 
     numFolds = int(numFolds) # Force conversion of numFolds
     symmetricFold = bool(symmetricFold) # Force conversion of symmetricFold boolean
@@ -322,6 +339,10 @@ def generateControlPointsFullCircle(minRuffleWdith, maxRuffleWidth, minBaseWdith
         y = r * math.sin(math.radians(theta_value_degrees))
         controlPointsCartesian.append([x, y, 0])
 
+    if periodic:
+        # The last point returned to the first one, the periodic curve closes the loop by itself
+        return controlPointsCartesian[:-1], randomSeed
+
     # Try to smoothen the start and the end
     controlPointsCartesian[-2] = [controlPointsCartesian[0][0] * 2 - controlPointsCartesian[1][0], 
                                   controlPointsCartesian[0][1] * 2 - controlPointsCartesian[1][1], 0]
@@ -330,6 +351,7 @@ def generateControlPointsFullCircle(minRuffleWdith, maxRuffleWidth, minBaseWdith
 
 def testFullCircle(numFold = 4, degree = 3, radius = 20, resolution = 0.5):
     # Create a 3-dimensional B-spline Curve
+    geomdl, BSpline, VisMPL = importGeomdl()
     curve = BSpline.Curve()
     # Set degrees
     curve.degree = degree
@@ -356,20 +378,219 @@ def testFullCircle(numFold = 4, degree = 3, radius = 20, resolution = 0.5):
     curve.render()
     return curve_points
 
-def getCurvePoints(ctrlPoints, degree = 3, resolution = 0.5):
+# Generate a clamped, equally spaced knot vector (same values as geomdl.knotvector.generate)
+def getKnotVector(degree, numCtrlPoints):
+    numSegments = numCtrlPoints - (degree + 1)
+    return np.concatenate((np.zeros(degree), np.linspace(0.0, 1.0, numSegments + 2), np.ones(degree)))
+
+# Evaluate the degree + 1 non-zero basis functions of the knot span of every parameter
+# Ref: Algorithm A2.2 from The NURBS Book by Piegl & Tiller
+def getBasisValues(degree, knots, spans, params):
+    numParams = params.shape[0]
+    basis = np.zeros((numParams, degree + 1))
+    basis[:, 0] = 1.0
+    left = np.zeros((numParams, degree + 1))
+    right = np.zeros((numParams, degree + 1))
+    for j in range(1, degree + 1):
+        left[:, j] = params - knots[spans + 1 - j]
+        right[:, j] = knots[spans + j] - params
+        saved = np.zeros(numParams)
+        for r in range(j):
+            temp = basis[:, r] / (right[:, r + 1] + left[:, j - r])
+            basis[:, r] = saved + right[:, r + 1] * temp
+            saved = left[:, j - r] * temp
+        basis[:, j] = saved
+    return basis
+
+# Evaluate the non-zero B-spline basis functions at the given parameters
+# Returns the control point index of every non-zero basis value and the basis values themselves,
+# both of shape (number of parameters, degree + 1), so the curve is just a weighted sum of control points
+# Ref: Algorithm A2.1 and A2.2 from The NURBS Book by Piegl & Tiller
+def getBasisFunctions(degree, numCtrlPoints, params):
+    knots = getKnotVector(degree, numCtrlPoints)
+    # Find the knot span of every parameter, the last span is reused for u = 1
+    spans = np.searchsorted(knots, params, side='right') - 1
+    spans = np.clip(spans, degree, numCtrlPoints - 1)
+    basis = getBasisValues(degree, knots, spans, params)
+    indices = spans[:, None] - degree + np.arange(degree + 1)
+    return indices, basis
+
+# Same as getBasisFunctions for a uniform periodic (closed) B-spline, params in [0, 1) go around the loop once
+# Every control point starts one span of equal length and the indices wrap around, so each span uses the
+# same basis kernel and evaluating the curve is a circular convolution of the control points with it
+# The indices are shifted by half the degree so the curve starts next to the first control point
+def getPeriodicBasisFunctions(degree, numCtrlPoints, params):
+    spanParams = np.mod(params, 1.0) * numCtrlPoints
+    segments = np.minimum(np.floor(spanParams).astype(np.int64), numCtrlPoints - 1)
+    # Local integer knots around the span [0, 1), all spans of a uniform curve look the same
+    localKnots = np.arange(-degree, degree + 2, dtype=float)
+    basis = getBasisValues(degree, localKnots, np.full(segments.shape[0], degree), spanParams - segments)
+    indices = (segments[:, None] - degree // 2 + np.arange(degree + 1)) % numCtrlPoints
+    return indices, basis
+
+# Finest resolution accepted, the cached basis of one curve holds (degree + 1) * 2 values per sample
+# so 1e-4 keeps every entry below 1 MB (1e-6 would need 61 MB per entry)
+MIN_RESOLUTION = 0.0001
+
+# Same checks as geomdl's delta property, plus the lower bound
+def checkResolution(resolution):
+    if float(resolution) < MIN_RESOLUTION or float(resolution) >= 1:
+        raise ValueError("Curve evaluation delta should be between {} and 1.0".format(MIN_RESOLUTION))
+
+# Get the number of curve points generated for a resolution (same as geomdl's sample_size)
+def getSampleSize(resolution):
+    return int(math.floor((1.0 / resolution) + 0.5))
+
+# Precompute the basis for a uniform parameter step, cached for repeated (degree, count, resolution) requests
+@lru_cache(maxsize=32)
+def getBasisMatrix(degree, numCtrlPoints, resolution):
+    # Use the same sample count and parameter range as geomdl's evalpts
+    params = np.linspace(0.0, 1.0, getSampleSize(resolution))
+    indices, basis = getBasisFunctions(degree, numCtrlPoints, params)
+    # Cached arrays are shared between callers, do not allow them to be modified
+    indices.setflags(write=False)
+    basis.setflags(write=False)
+    return indices, basis
+
+# Periodic version of getBasisMatrix, the same number of samples spread over the loop without repeating
+# the first point at the end (a closed curve has no seam to duplicate)
+@lru_cache(maxsize=32)
+def getPeriodicBasisMatrix(degree, numCtrlPoints, resolution):
+    sampleSize = getSampleSize(resolution)
+    indices, basis = getPeriodicBasisFunctions(degree, numCtrlPoints, np.arange(sampleSize) / sampleSize)
+    indices.setflags(write=False)
+    basis.setflags(write=False)
+    return indices, basis
+
+# Evaluate a dense uniform pilot curve used to decide where adaptive samples go
+# Periodic pilot curves repeat their first point at parameter 1 so the segments cover the whole loop
+def getPilotCurve(ctrlPoints, degree, sampleSize, periodic = False):
+    pilotSize = max(4 * sampleSize, 32 * ctrlPoints.shape[0])
+    if periodic:
+        indices, basis = getPeriodicBasisMatrix(degree, ctrlPoints.shape[0], 1.0 / pilotSize)
+        points = np.einsum('ij,ijk->ik', basis, ctrlPoints[indices])
+        return np.linspace(0.0, 1.0, pilotSize + 1), np.vstack((points, points[:1]))
+    indices, basis = getBasisMatrix(degree, ctrlPoints.shape[0], 1.0 / pilotSize)
+    return np.linspace(0.0, 1.0, pilotSize), np.einsum('ij,ijk->ik', basis, ctrlPoints[indices])
+
+# Get the length and the turning angle of every segment of a polyline
+def getSegmentWeights(points):
+    segments = np.diff(points, axis=0)
+    lengths = np.linalg.norm(segments, axis=1)
+    headings = np.arctan2(segments[:, 1], segments[:, 0])
+    # Turning angle at every interior point, wrapped to [0, pi]
+    turns = np.abs(np.angle(np.exp(1j * np.diff(headings))))
+    # Split the turning angle of each point between the two segments touching it
+    angles = np.zeros(lengths.shape[0])
+    angles[:-1] += turns / 2.0
+    angles[1:] += turns / 2.0
+    return lengths, angles
+
+# Get the sampling density of every pilot segment, normalized so it sums up to 1
+# arclength: equal distance between points
+# curvature: half of the points spread by distance, half by turning angle so fold tips get more points
+def getSampleDensity(ctrlPoints, degree, sampleSize, sampling, periodic = False):
+    pilotParams, pilotPoints = getPilotCurve(ctrlPoints, degree, sampleSize, periodic)
+    lengths, angles = getSegmentWeights(pilotPoints)
+    density = np.zeros(lengths.shape[0])
+    if lengths.sum() > 0:
+        density += lengths / lengths.sum()
+    if sampling == 'curvature' and angles.sum() > 0:
+        density += angles / angles.sum()
+    if density.sum() == 0:
+        density += 1.0 # Degenerate curve, fall back to uniform
+    return pilotParams, density / density.sum()
+
+# Get the curve parameters of the samples for the given sampling mode, to be passed to getCurvePoints
+# Passing several control point sets (e.g. the top and bottom hemline of a skirt) averages their densities,
+# so every curve evaluated with the returned parameters has its points at matching positions for lofting
+# periodic: parameters for getCurvePoints(periodic = True), in [0, 1) without a repeated end point
+def getSampleParams(ctrlPointSets, degree = 3, resolution = 0.5, sampling = 'uniform', periodic = False):
+    if sampling == 'uniform':
+        return None # Uniform samples use the cached basis in getCurvePoints
+    checkResolution(resolution)
+    sampleSize = getSampleSize(resolution)
+    if sampling not in ('arclength', 'curvature'):
+        raise ValueError("Unknown sampling mode '{}'".format(sampling))
+    totalDensity = None
+    for ctrlPoints in ctrlPointSets:
+        pilotParams, density = getSampleDensity(np.asarray(ctrlPoints, dtype=float), degree, sampleSize, sampling, periodic)
+        totalDensity = density if totalDensity is None else totalDensity + density
+    # Invert the cumulative density so every sample covers an equal share of it
+    cumulative = np.concatenate(([0.0], np.cumsum(totalDensity)))
+    cumulative /= cumulative[-1]
+    if periodic:
+        return np.interp(np.arange(sampleSize) / sampleSize, cumulative, pilotParams)
+    return np.interp(np.linspace(0.0, 1.0, sampleSize), cumulative, pilotParams)
+
+# Get the resolution needed for curvature sampling to keep the turning angle between
+# two consecutive segments below maxAngle (in degrees) on every given curve
+# Use the same resolution for all curves that are lofted together so they keep equal point counts
+# The result is never finer than MIN_RESOLUTION, so very small angles are only met as far as that allows
+def getAdaptiveResolution(ctrlPointSets, degree = 3, maxAngle = 5.0, pilotResolution = 0.0005, periodic = False):
+    sampleSize = 2
+    numCurves = len(ctrlPointSets)
+    for ctrlPoints in ctrlPointSets:
+        ctrlPoints = np.asarray(ctrlPoints, dtype=float)
+        pilotParams, pilotPoints = getPilotCurve(ctrlPoints, degree, getSampleSize(pilotResolution), periodic)
+        lengths, angles = getSegmentWeights(pilotPoints)
+        # Each curve's turning angle gets 1 / (2 * numCurves) of the shared density,
+        # so one sample interval covers at most 2 * numCurves * total / (n - 1) of it
+        sampleSize = max(sampleSize, int(math.ceil(2.0 * numCurves * angles.sum() / math.radians(maxAngle))) + 1)
+    return max(MIN_RESOLUTION, 1.0 / sampleSize)
+
+# periodic: treat the control points as a closed loop (uniform periodic B-spline) instead of a clamped curve,
+# the curve is smooth everywhere and its last point does not repeat the first one
+def getCurvePoints(ctrlPoints, degree = 3, resolution = 0.5, sampling = 'uniform', params = None, periodic = False):
+    checkResolution(resolution)
+    ctrlPoints = np.asarray(ctrlPoints, dtype=float)
+    if params is None and sampling != 'uniform':
+        params = getSampleParams([ctrlPoints], degree, resolution, sampling, periodic)
+    if params is None:
+        getMatrix = getPeriodicBasisMatrix if periodic else getBasisMatrix
+        indices, basis = getMatrix(int(degree), ctrlPoints.shape[0], float(resolution))
+    else:
+        getFunctions = getPeriodicBasisFunctions if periodic else getBasisFunctions
+        indices, basis = getFunctions(int(degree), ctrlPoints.shape[0], np.asarray(params, dtype=float))
+    # Weighted sum of the degree + 1 control points influencing each sample
+    curve_points = np.einsum('ij,ijk->ik', basis, ctrlPoints[indices])
+    return curve_points
+
+# Compare the NumPy evaluation against geomdl's evalpts
+def testCurvePoints(numFold = 20, degree = 3, resolution = 0.0005):
+    ctrlPoints, seedUsed = generateControlPointsFullCircle(6, 8, 4, 5, 1, 3, 20, numFold, False, uniformCircle = True)
+    geomdl, BSpline, VisMPL = importGeomdl()
     curve = BSpline.Curve()
-    # Set degrees
     curve.degree = degree
-    # Test the points generated for the polar coordinate
     curve.ctrlpts = ctrlPoints
     curve.knotvector = geomdl.knotvector.generate(degree, len(ctrlPoints), clamped=True)
-    # Set evaluation delta (controls the number of curve points)
-    curve.delta = resolution # Set to smaller to get smoother line
-    # Get curve points (the curve will be automatically evaluated)
-    curve_points = curve.evalpts
-    return curve_points
+    curve.delta = resolution
+    expected = np.array(curve.evalpts)
+    curve_points = getCurvePoints(ctrlPoints, degree = degree, resolution = resolution)
+    maxError = np.max(np.abs(expected - curve_points))
+    print("Seed {}: {} points, max difference from geomdl {}".format(seedUsed, curve_points.shape[0], maxError))
+    return maxError
+
+# Check the periodic evaluation closes the loop smoothly: the step from the last point back to the first
+# is like every other step and the curve repeats after one period
+def testPeriodicCurvePoints(numFold = 20, degree = 3, resolution = 0.0005):
+    ctrlPoints, seedUsed = generateControlPointsFullCircle(6, 8, 4, 5, 1, 3, 20, numFold, False, uniformCircle = True, \
+                                                           periodic = True)
+    ctrlPoints = np.asarray(ctrlPoints, dtype=float)
+    curve_points = getCurvePoints(ctrlPoints, degree = degree, resolution = resolution, periodic = True)
+    steps = np.linalg.norm(np.diff(np.vstack((curve_points, curve_points[:1])), axis=0), axis=1)
+    params = np.linspace(0.0, 1.0, 101)[:-1]
+    indices, basis = getPeriodicBasisFunctions(degree, ctrlPoints.shape[0], params)
+    shiftedIndices, shiftedBasis = getPeriodicBasisFunctions(degree, ctrlPoints.shape[0], params + 1.0)
+    periodError = np.max(np.abs(np.einsum('ij,ijk->ik', basis, ctrlPoints[indices]) - \
+                                np.einsum('ij,ijk->ik', shiftedBasis, ctrlPoints[shiftedIndices])))
+    print("Seed {}: {} points, seam step {:.4f} (steps {:.4f} to {:.4f}), period error {}".format( \
+          seedUsed, curve_points.shape[0], steps[-1], steps[:-1].min(), steps[:-1].max(), periodError))
+    return steps[-1], periodError
 
 if __name__ == "__main__":
+    testCurvePoints()
+    testPeriodicCurvePoints()
     testCartesian(numFold = 8, resolution = 0.005)
     testPolar(numFold = 4, resolution = 0.005)
     testFullCircle(numFold = 22, resolution = 0.0001)
\ No newline at end of file
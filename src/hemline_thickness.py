@@ -1,69 +1,52 @@
-import matplotlib.pyplot as plt
 import numpy as np
 import math
 
-from hemline_bspline import testCartesian, testPolar, testFullCircle # Test code-generated line
-
-def thickenHemline(hemline, thickness = 0.5):
-    plusDelta = []
-    minusDelta = []
+# Offset every point of the hemline by thickness on both sides, along the bisector of its neighbours
+# closed: treat the hemline as a loop, so the first and last points use each other as neighbours
+# (a duplicated seam point, as produced by the clamped full circle curve, is detected and skipped)
+def thickenHemline(hemline, thickness = 0.5, closed = False):
+    hemline = np.asarray(hemline)
     hemlineX = hemline[:, 0]
     hemlineY = hemline[:, 1]
-    # Handle the first point using only its coord and the second point's coordinate
-    nextPointX = hemlineX[1]
-    currPointX = hemlineX[0]
-    nextPointY = hemlineY[1]
-    currPointY = hemlineY[0]
-    beta = None
-    beta = math.atan2((nextPointY - currPointY), (nextPointX - currPointX))
-    deltaAngle = beta + math.pi/2
-    # Calculate delta from the current point
-    deltaX = thickness * math.cos(deltaAngle)
-    deltaY = thickness * math.sin(deltaAngle)
-    # Append the deviated point's coordinates
-    plusDelta.append([currPointX + deltaX, currPointY + deltaY])
-    minusDelta.append([currPointX - deltaX, currPointY - deltaY])
-    # Skip the first and last point's thickening in angle approximation method
-    for pointIter in range(1, hemline.shape[0] - 1):
-        # Get the current point's coordinate and the neighboring points' coordinates
-        prevPointX = hemlineX[pointIter - 1]
-        nextPointX = hemlineX[pointIter + 1]
-        currPointX = hemlineX[pointIter]
-        prevPointY = hemlineY[pointIter - 1]
-        nextPointY = hemlineY[pointIter + 1]
-        currPointY = hemlineY[pointIter]
-        prevAngle = math.atan2((prevPointY - currPointY), (prevPointX - currPointX))
-        nextAngle = math.atan2((nextPointY - currPointY), (nextPointX - currPointX))
-        openAngle = prevAngle - nextAngle
-        deltaAngle = nextAngle + openAngle / 2.0
-        # Calculate delta from the current point
-        deltaX = thickness * math.cos(deltaAngle)
-        deltaY = thickness * math.sin(deltaAngle)
-        if openAngle < 0:
-            deltaX = -deltaX
-            deltaY = -deltaY
-        # Append the deviated point's coordinates
-        plusDeltaCoord = [currPointX + deltaX, currPointY + deltaY]
-        minusDeltaCoord = [currPointX - deltaX, currPointY - deltaY]
-        plusDelta.append(plusDeltaCoord)
-        minusDelta.append(minusDeltaCoord)
-    # Handle the last point using only its coord and the second last point's coordinate
-    prevPointX = hemlineX[hemline.shape[0] - 2]
-    currPointX = hemlineX[hemline.shape[0] - 1]
-    prevPointY = hemlineY[hemline.shape[0] - 2]
-    currPointY = hemlineY[hemline.shape[0] - 1]
-    beta = math.atan2((prevPointY - currPointY), (prevPointX - currPointX))
-    deltaAngle = beta - math.pi/2
-    # Calculate delta from the current point
-    deltaX = thickness * math.cos(deltaAngle)
-    deltaY = thickness * math.sin(deltaAngle)
-    # Append the deviated point's coordinates
-    plusDelta.append([currPointX + deltaX, currPointY + deltaY])
-    minusDelta.append([currPointX - deltaX, currPointY - deltaY])
-    return np.array(plusDelta), np.array(minusDelta)
+    numPoints = hemline.shape[0]
+    pointIters = np.arange(numPoints)
+    prevIters = pointIters - 1
+    nextIters = pointIters + 1
+    if closed:
+        # Skip the duplicated seam point when the curve ends where it started
+        seamOffset = 1 if np.allclose(hemline[0, :2], hemline[-1, :2]) else 0
+        prevIters[0] = numPoints - 1 - seamOffset
+        nextIters[-1] = seamOffset
+    else:
+        # Open ends only have one neighbour, use the point itself for the missing one
+        prevIters[0] = 0
+        nextIters[-1] = numPoints - 1
+    # Angles from each point to its neighbours
+    prevAngle = np.arctan2(hemlineY[prevIters] - hemlineY, hemlineX[prevIters] - hemlineX)
+    nextAngle = np.arctan2(hemlineY[nextIters] - hemlineY, hemlineX[nextIters] - hemlineX)
+    openAngle = prevAngle - nextAngle
+    deltaAngle = nextAngle + openAngle / 2.0
+    # Calculate delta from every point
+    deltaX = thickness * np.cos(deltaAngle)
+    deltaY = thickness * np.sin(deltaAngle)
+    # Flip the deltas that were calculated on the other side of the curve
+    flip = np.where(openAngle < 0, -1.0, 1.0)
+    if not closed:
+        # Handle the first and last point using only the direction to their single neighbour
+        flip[0] = 1.0
+        flip[-1] = 1.0
+        firstAngle = nextAngle[0] + math.pi/2
+        lastAngle = prevAngle[-1] - math.pi/2
+        deltaX[0], deltaY[0] = thickness * math.cos(firstAngle), thickness * math.sin(firstAngle)
+        deltaX[-1], deltaY[-1] = thickness * math.cos(lastAngle), thickness * math.sin(lastAngle)
+    deltas = np.column_stack((deltaX * flip, deltaY * flip))
+    plusDelta = hemline[:, :2] + deltas
+    minusDelta = hemline[:, :2] - deltas
+    return plusDelta, minusDelta
 
-def testThickness(testHemline, thickness = 0.5):
-    plusDelta, minusDelta = thickenHemline(testHemline, thickness)
+def testThickness(testHemline, thickness = 0.5, closed = False):
+    import matplotlib.pyplot as plt # Only needed for plotting, keep it out of the generation workers
+    plusDelta, minusDelta = thickenHemline(testHemline, thickness, closed)
     hemlineX = testHemline[:, 0]
     hemlineY = testHemline[:, 1]
     plt.plot(hemlineX, hemlineY, color='black', linestyle='--', linewidth=2, marker='o')
@@ -76,7 +59,8 @@ def testThickness(testHemline, thickness = 0.5):
     return plusDelta, minusDelta
 
 if __name__ == "__main__":
+    from hemline_bspline import testCartesian, testPolar, testFullCircle # Test code-generated line
     sampleHemline = np.array(testCartesian(numFold = 8, resolution = 0.01))
     sampleHemline = np.array(testPolar(numFold = 4, resolution = 0.01))
     sampleHemline = np.array(testFullCircle(numFold = 20, resolution = 0.0001))
-    testThickness(sampleHemline, thickness = 0.5)
\ No newline at end of file
+    testThickness(sampleHemline, thickness = 0.5, closed = True)
\ No newline at end of file
@@ -1,15 +1,64 @@
 from enum import Enum
-import io, random, base64
-from fastapi import FastAPI, Query, Request
-from fastapi.responses import HTMLResponse, JSONResponse
+from typing import Dict, List, Optional
+import os, random, base64, zlib, zipfile, json, asyncio, itertools, math
+from fastapi import FastAPI, HTTPException, Query, Request, WebSocket, WebSocketDisconnect
+from pydantic import BaseModel, Field, ValidationError
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
+from helper import generateMeshFileTraced
+from hemline_bspline import MIN_RESOLUTION
+from generation_pool import GenerationPool, PoolBusyError, JobTimeoutError, ClientDisconnectedError
+from mesh_cache import MeshCache, getCacheKey
+from metrics import createGenerationMetrics, getResolutionBucket, measureSpan
+from profiling import profileCall
+
+# Brotli is optional, gzip is used when it is not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
 app = FastAPI()
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 # Set up the template engine
-templates = Jinja2Templates(directory="templates")
+templates = Jinja2Templates(directory="template")
+
+# Size of the chunks streamed back for binary responses
+STREAM_CHUNK_SIZE = 64 * 1024
+
+# Coarse previews sample each fold this many times, with curvature sampling to keep the fold tips
+LOD_SAMPLES_PER_FOLD = 24
+MULTIPART_BOUNDARY = "ruffle-lod"
+
+# Cache of generated STL files, the disk tier is only used when RUFFLE_CACHE_DIR is set
+mesh_cache = MeshCache(memoryBytes=int(os.environ.get("RUFFLE_CACHE_MEMORY_BYTES", 64 * 1024 * 1024)),
+                       diskDir=os.environ.get("RUFFLE_CACHE_DIR"),
+                       diskBytes=int(os.environ.get("RUFFLE_CACHE_DISK_BYTES", 1024 * 1024 * 1024)))
+
+# Worker processes running the generation, RUFFLE_WORKERS=0 generates in the server process instead
+generation_pool = GenerationPool(maxWorkers=int(os.environ["RUFFLE_WORKERS"]) if "RUFFLE_WORKERS" in os.environ else None,
+                                 maxQueue=int(os.environ.get("RUFFLE_MAX_QUEUE", 32)),
+                                 timeout=float(os.environ.get("RUFFLE_JOB_TIMEOUT", 30)))
+
+# Per-stage timings and mesh sizes of every generation, exported on /metrics
+generation_metrics = createGenerationMetrics()
+
+# Allow single requests to be profiled with ?profile=true or X-Profile: 1
+PROFILING_ENABLED = os.environ.get("RUFFLE_PROFILING") == "1"
+
+# Validate every generated mesh and run the trimesh repair on invalid ones (slower, off by default)
+REPAIR_MESHES = os.environ.get("RUFFLE_REPAIR_MESHES") == "1"
+
+@app.on_event("startup")
+def start_generation_pool():
+    generation_pool.warm()
+
+@app.on_event("shutdown")
+def stop_generation_pool():
+    generation_pool.shutdown()
 
 class MeshType(str, Enum):
     curtain = "curtain"
@@ -17,7 +66,31 @@ class MeshType(str, Enum):
     cape = "cape"
     skirt = "skirt"
 
-def generate_stl_with_seed(type: MeshType = MeshType.curtain,
+class MeshFormat(str, Enum):
+    stl = "stl" # Binary STL triangle soup
+    ply = "ply" # Binary PLY with shared vertices
+    glb = "glb" # glTF binary with shared vertices, loadable with GLTFLoader
+    rfm = "rfm" # Quantized compact mesh, decoded by static/index.js
+
+# Content type of every mesh format
+MESH_MEDIA_TYPES = {MeshFormat.stl: "application/sla", MeshFormat.ply: "application/octet-stream",
+                    MeshFormat.glb: "model/gltf-binary", MeshFormat.rfm: "application/x-ruffle-mesh"}
+
+class LevelOfDetail(str, Enum):
+    full = "full" # Only the mesh at the requested resolution
+    coarse = "coarse" # A quick low resolution mesh, X-Refine-Url points to the full one
+    progressive = "progressive" # Coarse then full mesh as two parts of one multipart/mixed stream
+
+class ResponseMode(str, Enum):
+    binary = "binary" # Raw binary STL body, seed in the X-Seed header
+    json = "json" # Base64 STL and seed wrapped in a JSON object
+
+class SamplingMode(str, Enum):
+    uniform = "uniform" # Equal steps of the curve parameter
+    arclength = "arclength" # Equal steps along the hemline
+    curvature = "curvature" # More samples on the fold tips, fewer on flat stretches
+
+async def generate_stl_with_seed(type: MeshType = MeshType.curtain,
                             numFolds: int = 5,
                             minRuffleWidth: float = 0.1,
                             maxRuffleWidth: float = 0.3,
@@ -29,30 +102,142 @@ def generate_stl_with_seed(type: MeshType = MeshType.curtain,
                             thickness: float = 0.5,
                             resolution: float = 0.001,
                             symmetricFold: bool = False,
-                            seed: int = None):
-    # Use provided seed or generate one
-    actual_seed = seed if seed is not None else random.randint(0, 1e9)
-    random.seed(actual_seed)
-
-    # Generate mesh here, default type is curtain
-    mesh = #TODO: generate mesh with given parameters
-    # if type == MeshType.curtain:
-    if type == MeshType.tube:
-    elif type == MeshType.cape:
-    elif type == MeshType.skirt:
-
-    # Save STL to BytesIO
-    stl_io = io.BytesIO()
-    mesh.save(stl_io)
-    stl_io.seek(0)
-    
-    # Convert to base64 so it can be returned as JSON
-    stl_base64 = base64.b64encode(stl_io.read()).decode('utf-8')
-    
-    return {"stl_data": stl_base64, "seed": actual_seed}
+                            seed: int = None,
+                            height: float = 5,
+                            sampling: SamplingMode = SamplingMode.uniform,
+                            format: MeshFormat = MeshFormat.stl,
+                            periodic: bool = False,
+                            tiers: int = 1,
+                            ringsBetween: int = 0,
+                            maxFaces: Optional[int] = None,
+                            tolerance: float = 0,
+                            maxAngle: Optional[float] = None,
+                            is_disconnected = None):
+    # Use provided seed or generate one, the module-global random state is never seeded
+    # so concurrent requests can not interfere with each other
+    actual_seed = seed if seed is not None else random.SystemRandom().randint(0, int(1e9))
+
+    # The output only depends on the parameters and the seed, reuse it if it was generated before
+    cache_key = getCacheKey(type=type, numFolds=numFolds, minRuffleWidth=minRuffleWidth, maxRuffleWidth=maxRuffleWidth,
+                            minBaseWidth=minBaseWidth, maxBaseWidth=maxBaseWidth, minHeight=minHeight,
+                            maxHeight=maxHeight, radius=radius, thickness=thickness, resolution=resolution,
+                            symmetricFold=symmetricFold, seed=actual_seed, height=height, sampling=sampling,
+                            format=format, repair=REPAIR_MESHES, periodic=periodic,
+                            tiers=tiers, ringsBetween=ringsBetween, maxFaces=maxFaces, tolerance=tolerance,
+                            maxAngle=maxAngle)
+    labels = get_metric_labels(type, resolution)
+    mesh_data = await mesh_cache.getAsync(cache_key)
+    if mesh_data is not None:
+        generation_metrics.inc("ruffle_generations_total", result="cache_hit", **labels)
+        return {"mesh_data": mesh_data, "seed": actual_seed}
+
+    # Generate mesh in a worker process, default type is curtain
+    # Jobs sharing the hemline stages (everything but thickness, height, decimation and format) go to the same
+    # worker when it is not overloaded, so a height-only edit reuses the hemlines cached in that worker
+    affinity = (type.value, numFolds, minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, minHeight, maxHeight,
+                radius, resolution, symmetricFold, actual_seed, sampling.value, periodic, tiers, maxAngle)
+    # The job span covers queueing and transfer from the worker on top of the stage spans measured in the worker
+    spans = []
+    try:
+        with measureSpan(spans, "job"):
+            mesh_data, job = await generation_pool.run(generateMeshFileTraced, type.value, numFolds, minRuffleWidth,
+                                                       maxRuffleWidth, minBaseWidth, maxBaseWidth, minHeight, maxHeight,
+                                                       radius, thickness, resolution, symmetricFold, actual_seed, height,
+                                                       sampling.value, format.value, REPAIR_MESHES, True, periodic, tiers,
+                                                       ringsBetween, maxFaces, tolerance, maxAngle,
+                                                       isDisconnected=is_disconnected, affinity=affinity)
+    except Exception:
+        generation_metrics.inc("ruffle_generations_total", result="error", **labels)
+        raise
+    job["spans"].extend(spans)
+    generation_metrics.recordJob(job, **labels)
+    generation_metrics.inc("ruffle_generations_total", result="generated", **labels)
+    mesh_cache.putAsync(cache_key, mesh_data)
+    return {"mesh_data": mesh_data, "seed": actual_seed}
+
+# Labels of the generation metrics, resolutions are grouped into buckets to keep the number of series small
+def get_metric_labels(type: MeshType, resolution: float):
+    return {"mesh_type": type.value, "resolution": getResolutionBucket(resolution)}
+
+# Await a generation job, turning its errors into HTTP errors
+async def await_generation(job):
+    try:
+        return await job
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+    except PoolBusyError as error:
+        raise HTTPException(status_code=503, detail=str(error))
+    except JobTimeoutError as error:
+        raise HTTPException(status_code=504, detail=str(error))
+    except ClientDisconnectedError as error:
+        raise HTTPException(status_code=499, detail=str(error)) # Nobody is listening anymore
+
+# Generate one mesh under the profiler, skipping the mesh and stage caches so every stage really runs
+# Answers with the hot functions and a collapsed-stack file (for flamegraph.pl or speedscope) instead of the mesh
+async def profile_generation(type: MeshType, numFolds: int, minRuffleWidth: float, maxRuffleWidth: float,
+                             minBaseWidth: float, maxBaseWidth: float, minHeight: float, maxHeight: float,
+                             radius: float, thickness: float, resolution: float, symmetricFold: bool, seed: int,
+                             height: float, format: MeshFormat, periodic: bool = False, tiers: int = 1,
+                             ringsBetween: int = 0, maxFaces: Optional[int] = None, tolerance: float = 0,
+                             maxAngle: Optional[float] = None, sampling: SamplingMode = SamplingMode.uniform,
+                             is_disconnected = None):
+    (mesh_data, job), profile = await generation_pool.run(profileCall, generateMeshFileTraced, type.value, numFolds,
+                                                          minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth,
+                                                          minHeight, maxHeight, radius, thickness, resolution,
+                                                          symmetricFold, seed, height, sampling.value, format.value,
+                                                          REPAIR_MESHES, False, periodic, tiers, ringsBetween,
+                                                          maxFaces, tolerance, maxAngle, isDisconnected=is_disconnected)
+    return JSONResponse(content={"seed": seed, "format": format.value, "size": len(mesh_data),
+                                 "vertices": job["vertices"], "faces": job["faces"], "spans": job["spans"],
+                                 "seconds": profile["seconds"], "top": profile["top"],
+                                 "collapsed": profile["collapsed"]})
+
+# Resolution of the coarse preview mesh, never finer than the requested resolution
+def get_coarse_resolution(numFolds: int, resolution: float):
+    return max(resolution, 1.0 / (LOD_SAMPLES_PER_FOLD * max(1, numFolds)))
+
+# Pick the best content encoding the client accepts, by q-value with brotli winning ties
+# Encodings with q=0 are refused, "*" stands for every encoding not listed
+def negotiate_encoding(accept_encoding: str):
+    weights = {}
+    for value in accept_encoding.lower().split(","):
+        name, *options = [part.strip() for part in value.split(";")]
+        weight = 1.0
+        for option in options:
+            key, _, number = option.partition("=")
+            if key.strip() == "q":
+                try:
+                    weight = float(number)
+                except ValueError:
+                    weight = 0.0 # Malformed q-value, ignore the encoding
+        if name:
+            weights[name] = weight
+    supported = (["br"] if brotli is not None else []) + ["gzip"]
+    best = max(supported, key=lambda name: weights.get(name, weights.get("*", 0.0)))
+    if weights.get(best, weights.get("*", 0.0)) <= 0:
+        return None
+    return best
+
+# Yield the mesh buffer in chunks, compressing them on the fly if an encoding was negotiated
+def stream_mesh(mesh_data, encoding):
+    view = memoryview(mesh_data)
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=4)
+        for start in range(0, len(view), STREAM_CHUNK_SIZE):
+            yield compressor.process(view[start:start + STREAM_CHUNK_SIZE].tobytes())
+        yield compressor.finish()
+    elif encoding == "gzip":
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) # wbits 31 writes a gzip container
+        for start in range(0, len(view), STREAM_CHUNK_SIZE):
+            yield compressor.compress(view[start:start + STREAM_CHUNK_SIZE])
+        yield compressor.flush()
+    else:
+        for start in range(0, len(view), STREAM_CHUNK_SIZE):
+            yield view[start:start + STREAM_CHUNK_SIZE].tobytes()
 
 @app.get("/generate-stl")
-def generate_stl(type: MeshType = Query(..., description="Type of mesh to generate"),
+async def generate_stl(request: Request,
+                type: MeshType = Query(..., description="Type of mesh to generate"),
                 numFolds: int = Query(5, ge=1, le=100),
                 minRuffleWidth: float = Query(0.1),
                 maxRuffleWidth: float = Query(0.3),
@@ -61,14 +246,321 @@ def generate_stl(type: MeshType = Query(..., description="Type of mesh to genera
                 minHeight: float = Query(0.1),
                 maxHeight: float = Query(0.3),
                 radius: float = Query(0.3),
-                thickness: float = Query(0.001),
-                resolution: float = Query(0.5),
+                thickness: float = Query(0.5),
+                resolution: float = Query(0.001, ge=MIN_RESOLUTION, lt=1),
                 symmetricFold: bool = Query(False),
-                seed: int = Query(None)):
-    result = generate_stl_with_seed(seed)
-    return JSONResponse(content=result)
+                seed: int = Query(None),
+                height: float = Query(5, gt=0),
+                mode: ResponseMode = Query(ResponseMode.binary, description="Raw binary STL or base64 in JSON"),
+                lod: LevelOfDetail = Query(LevelOfDetail.full, description="Full, coarse preview or both in order"),
+                format: MeshFormat = Query(MeshFormat.stl, description="Output file format"),
+                periodic: bool = Query(False, description="Seamless periodic B-spline hemlines for tubes and skirts"),
+                tiers: int = Query(1, ge=1, le=16, description="Ruffled hemlines stacked on capes and skirts"),
+                ringsBetween: int = Query(0, ge=0, le=64, description="Rings interpolated between lofted hemlines"),
+                maxFaces: Optional[int] = Query(None, ge=1, description="Simplify flat stretches down to this many faces"),
+                tolerance: float = Query(0, ge=0, description="Drop hemline samples that move the hemline by at most this"),
+                sampling: SamplingMode = Query(SamplingMode.uniform, description="Hemline samples in equal parameter steps, equal lengths or by curvature"),
+                maxAngle: Optional[float] = Query(None, gt=0, le=90, description="Curvature sampling keeping every hemline turn below this many degrees, replaces resolution"),
+                profile: bool = Query(False, description="Profile this request (also X-Profile: 1), needs RUFFLE_PROFILING=1")):
+    # Fix the seed up front so the coarse and full meshes share it
+    if seed is None:
+        seed = random.SystemRandom().randint(0, int(1e9))
+    params = (type, numFolds, minRuffleWidth, maxRuffleWidth, minBaseWidth, maxBaseWidth, minHeight, maxHeight,
+              radius, thickness)
+    coarse_resolution = get_coarse_resolution(numFolds, resolution)
+
+    if profile or request.headers.get("x-profile", "").lower() in ("1", "true"):
+        if not PROFILING_ENABLED:
+            raise HTTPException(status_code=403, detail="Profiling is disabled, start the server with RUFFLE_PROFILING=1")
+        return await await_generation(profile_generation(*params, resolution, symmetricFold, seed, height, format,
+                                                         periodic, tiers, ringsBetween, maxFaces, tolerance, maxAngle,
+                                                         sampling, is_disconnected=request.is_disconnected))
+
+    # The coarse preview is curvature sampled at its own fixed sample count and never decimated, so maxAngle,
+    # maxFaces and tolerance only apply to the full mesh (a budget the preview can not meet must not fail it)
+    async def generate(lod_resolution, coarse=False):
+        return await await_generation(generate_stl_with_seed(*params, lod_resolution, symmetricFold, seed, height,
+                                                             SamplingMode.curvature if coarse else sampling, format, periodic,
+                                                             tiers, ringsBetween, None if coarse else maxFaces,
+                                                             0 if coarse else tolerance, None if coarse else maxAngle,
+                                                             is_disconnected=request.is_disconnected))
+
+    if lod == LevelOfDetail.progressive and mode == ResponseMode.binary:
+        # Generate the coarse mesh before answering so errors still give a proper status code
+        coarse = await generate(coarse_resolution, coarse=True)
+
+        async def stream_parts():
+            for part_lod, part in (("coarse", coarse), ("full", None)):
+                media_type = MESH_MEDIA_TYPES[format]
+                if part is None:
+                    try:
+                        part = await generate(resolution)
+                    except HTTPException as error:
+                        # The status line is already sent, the full part carries the error instead of the mesh
+                        media_type = "application/json"
+                        part = {"mesh_data": json.dumps({"status": error.status_code, "detail": error.detail}).encode("utf-8")}
+                yield ("--{}\r\nContent-Type: {}\r\nX-Lod: {}\r\nContent-Length: {}\r\n\r\n"
+                       .format(MULTIPART_BOUNDARY, media_type, part_lod, len(part["mesh_data"]))
+                       .encode("ascii"))
+                yield bytes(part["mesh_data"])
+                yield b"\r\n"
+            yield "--{}--\r\n".format(MULTIPART_BOUNDARY).encode("ascii")
+
+        return StreamingResponse(stream_parts(), headers={"X-Seed": str(seed), "Access-Control-Expose-Headers": "X-Seed"},
+                                 media_type="multipart/mixed; boundary={}".format(MULTIPART_BOUNDARY))
+
+    headers = {"X-Seed": str(seed), "X-Lod": "full"}
+    if lod == LevelOfDetail.full or coarse_resolution == resolution:
+        result = await generate(resolution)
+    else:
+        result = await generate(coarse_resolution, coarse=True)
+        # Same parameters and seed at full detail, identical to a normal request
+        headers["X-Lod"] = "coarse"
+        headers["X-Refine-Url"] = str(request.url.include_query_params(lod=LevelOfDetail.full.value, seed=seed))
+    headers["Access-Control-Expose-Headers"] = ", ".join(headers)
+
+    if mode == ResponseMode.json:
+        # Convert to base64 so it can be returned as JSON
+        spans = []
+        with measureSpan(spans, "base64"):
+            mesh_base64 = base64.b64encode(result["mesh_data"]).decode('utf-8')
+        generation_metrics.recordJob({"spans": spans}, **get_metric_labels(type, resolution))
+        return JSONResponse(content={"stl_data": mesh_base64, "seed": result["seed"], "format": format.value},
+                            headers=headers)
+
+    encoding = negotiate_encoding(request.headers.get("accept-encoding", ""))
+    headers["Vary"] = "Accept-Encoding"
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return StreamingResponse(stream_mesh(result["mesh_data"], encoding), media_type=MESH_MEDIA_TYPES[format],
+                             headers=headers)
+
+# Hit, miss and eviction counters of the mesh cache
+@app.get("/cache-stats")
+def cache_stats():
+    return mesh_cache.stats()
+
+# Prometheus metrics: stage durations, result sizes, mesh sizes and repairs by mesh type and resolution bucket,
+# plus the mesh cache counters
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    lines = [generation_metrics.render()]
+    for name, value in mesh_cache.stats().items():
+        # Hits, misses and evictions only grow and are counters, entries and bytes are current values
+        if name in mesh_cache.counters:
+            lines.append("# TYPE ruffle_mesh_cache_{0}_total counter\nruffle_mesh_cache_{0}_total {1}\n".format(name, value))
+        else:
+            lines.append("# TYPE ruffle_mesh_cache_{0} gauge\nruffle_mesh_cache_{0} {1}\n".format(name, value))
+    return PlainTextResponse("".join(lines), media_type="text/plain; version=0.0.4")
+
+# Largest number of meshes a single batch request may generate
+MAX_BATCH_ITEMS = 200
+
+# Mesh parameters shared by the batch and live-tweak endpoints
+class MeshParams(BaseModel):
+    type: MeshType = MeshType.curtain
+    numFolds: int = Field(5, ge=1, le=100)
+    minRuffleWidth: float = 0.1
+    maxRuffleWidth: float = 0.3
+    minBaseWidth: float = 0.1
+    maxBaseWidth: float = 0.3
+    minHeight: float = 0.1
+    maxHeight: float = 0.3
+    radius: float = 0.3
+    thickness: float = 0.5
+    resolution: float = Field(0.001, ge=MIN_RESOLUTION, lt=1)
+    symmetricFold: bool = False
+    height: float = Field(5, gt=0)
+    format: MeshFormat = MeshFormat.stl
+    periodic: bool = False
+    tiers: int = Field(1, ge=1, le=16)
+    ringsBetween: int = Field(0, ge=0, le=64)
+    maxFaces: Optional[int] = Field(None, ge=1)
+    tolerance: float = Field(0, ge=0)
+    maxAngle: Optional[float] = Field(None, gt=0, le=90)
+    sampling: SamplingMode = SamplingMode.uniform
+
+# Parameters of /generate-batch, every field of the grid is swept over its list of values
+class BatchRequest(MeshParams):
+    seeds: Optional[List[int]] = None # Explicit seeds, otherwise count random seeds are used
+    count: int = 1
+    grid: Dict[str, List[float]] = {}
+
+# Expand a batch request into the parameters of every mesh to generate
+def expand_batch(batch: BatchRequest):
+    base = batch.model_dump(exclude={"seeds", "count", "grid"})
+    for name in batch.grid:
+        if name not in base or name in ("type", "format", "sampling"):
+            raise ValueError("Unknown grid parameter '{}'".format(name))
+    # Check the size before expanding anything, the grid product grows fast
+    numItems = (len(batch.seeds) if batch.seeds else max(1, batch.count)) * math.prod(len(values) for values in batch.grid.values())
+    if numItems > MAX_BATCH_ITEMS:
+        raise ValueError("Batch would generate {} meshes, the limit is {}".format(numItems, MAX_BATCH_ITEMS))
+    # Grid values get the same bounds and types as the single mesh parameters, so 5.5 folds is an error, not 5
+    grid = {}
+    for name, values in batch.grid.items():
+        try:
+            grid[name] = [getattr(MeshParams.model_validate(dict(base, **{name: value})), name) for value in values]
+        except ValidationError as error:
+            raise ValueError("Invalid grid value for '{}': {}".format(name, error.errors()[0]["msg"]))
+    seeds = batch.seeds if batch.seeds else [random.SystemRandom().randint(0, int(1e9)) for _ in range(max(1, batch.count))]
+    names = list(grid)
+    items = []
+    for values in itertools.product(*(grid[name] for name in names)):
+        for seed in seeds:
+            items.append(dict(base, **dict(zip(names, values)), seed=seed))
+    return items
+
+# Write-only file object collecting what zipfile writes, so the archive can be streamed as it grows
+class ZipChunkWriter:
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+# Generate many variants in one call, returned as a zip streamed entry by entry as each mesh finishes
+# Items run in parallel across the worker processes, each worker reuses its cached knot vectors,
+# basis matrices and face topologies for every item sharing a resolution
+@app.post("/generate-batch")
+async def generate_batch(request: Request, batch: BatchRequest):
+    try:
+        items = expand_batch(batch)
+    except ValueError as error:
+        raise HTTPException(status_code=400, detail=str(error))
+
+    async def generate_item(index, params, semaphore):
+        async with semaphore:
+            try:
+                result = await generate_stl_with_seed(**params, is_disconnected=request.is_disconnected)
+            except (ValueError, PoolBusyError, JobTimeoutError) as error:
+                return index, params, None, str(error)
+        return index, params, result["mesh_data"], None
+
+    async def stream_zip():
+        writer = ZipChunkWriter()
+        archive = zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_DEFLATED)
+        # Keep at most one item per worker in flight so the batch does not fill the pool queue
+        semaphore = asyncio.Semaphore(max(1, generation_pool.maxWorkers))
+        tasks = [asyncio.ensure_future(generate_item(index, params, semaphore)) for index, params in enumerate(items)]
+        manifest = []
+        try:
+            for next_item in asyncio.as_completed(tasks):
+                index, params, mesh_data, error = await next_item
+                name = "{}_{:03d}_seed{}".format(params["type"].value, index, params["seed"])
+                if error is None:
+                    archive.writestr("{}.{}".format(name, params["format"].value), mesh_data)
+                else:
+                    archive.writestr(name + ".error.txt", error)
+                manifest.append(dict(params, type=params["type"].value, format=params["format"].value,
+                                     sampling=params["sampling"].value, file=name, error=error))
+                yield writer.take()
+            archive.writestr("manifest.json", json.dumps(sorted(manifest, key=lambda item: item["file"]), indent=2))
+            archive.close()
+            yield writer.take()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_zip(), media_type="application/zip",
+                             headers={"Content-Disposition": 'attachment; filename="ruffles.zip"'})
+
+# Quiet time after the last parameter update before a live-tweak job is started
+LIVE_DEBOUNCE_SECONDS = float(os.environ.get("RUFFLE_LIVE_DEBOUNCE", 0.15))
+
+# One parameter update sent over /ws/generate
+# Errors of receiving from or sending to a live socket whose client went away (closed socket, dropped connection)
+CLIENT_GONE_ERRORS = (WebSocketDisconnect, RuntimeError, OSError)
+
+class LiveRequest(MeshParams):
+    seed: Optional[int] = None
+
+# Live-tweak channel: the client sends every parameter change as a JSON message and the server only
+# generates the newest one once updates stop for LIVE_DEBOUNCE_SECONDS
+# Jobs superseded while waiting in the pool queue are dropped, a superseded job that already runs in a worker
+# finishes but its mesh is discarded. Each mesh is answered with a JSON header followed by the binary mesh
+@app.websocket("/ws/generate")
+async def live_generate(websocket: WebSocket):
+    await websocket.accept()
+    latest = {"version": 0, "params": None}
+    changed = asyncio.Event()
+    # Without an explicit seed the whole session shares one, so only the tweaked parameter changes the shape
+    session_seed = random.SystemRandom().randint(0, int(1e9))
+
+    # Send a reply (a JSON header, then the mesh if there is one), False once the client is gone
+    async def send_reply(header, mesh_data=None):
+        try:
+            await websocket.send_json(header)
+            if mesh_data is not None:
+                await websocket.send_bytes(bytes(mesh_data))
+        except CLIENT_GONE_ERRORS:
+            return False
+        return True
+
+    async def generate_latest():
+        while True:
+            await changed.wait()
+            # Debounce, restart the quiet period on every new update
+            while True:
+                changed.clear()
+                try:
+                    await asyncio.wait_for(changed.wait(), LIVE_DEBOUNCE_SECONDS)
+                except asyncio.TimeoutError:
+                    break
+            version, params = latest["version"], latest["params"]
+
+            async def is_superseded():
+                return latest["version"] != version
+
+            seed = params.seed if params.seed is not None else session_seed
+            try:
+                result = await generate_stl_with_seed(**params.model_dump(exclude={"seed"}), seed=seed,
+                                                      is_disconnected=is_superseded)
+            except ClientDisconnectedError:
+                continue # A newer update arrived while the job was queued
+            except Exception as error: # Any failure (bad parameters, busy or lost workers) only fails this update
+                if latest["version"] == version and not await send_reply({"version": version, "error": str(error)}):
+                    return
+                continue
+            if latest["version"] != version:
+                continue # Finished, but the client already asked for something else
+            if not await send_reply({"version": version, "seed": result["seed"], "format": params.format.value,
+                                     "content_type": MESH_MEDIA_TYPES[params.format],
+                                     "size": len(result["mesh_data"])}, result["mesh_data"]):
+                return # The client went away mid-send, the receive loop ends the session
+
+    generator = asyncio.ensure_future(generate_latest())
+    try:
+        while True:
+            try:
+                message = await websocket.receive_json()
+            except (ValueError, KeyError): # Malformed JSON or a binary frame
+                await websocket.send_json({"error": "Live updates must be JSON text messages"})
+                continue
+            try:
+                params = LiveRequest(**message)
+            except (ValidationError, TypeError) as error:
+                await websocket.send_json({"error": str(error)})
+                continue
+            latest["version"] += 1
+            latest["params"] = params
+            changed.set()
+    except CLIENT_GONE_ERRORS:
+        pass # Disconnects are the normal end of a session
+    finally:
+        generator.cancel()
+        await asyncio.gather(generator, return_exceptions=True)
 
 # Route for homepage
 @app.get("/", response_class=HTMLResponse)
 async def read_home(request: Request):
-    return templates.TemplateResponse("index.html", {"request": request})
\ No newline at end of file
+    return templates.TemplateResponse("index.html", {"request": request})
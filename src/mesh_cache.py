@@ -0,0 +1,172 @@
+# Two-tier cache for generated meshes
+# Generation is deterministic for a given parameter set and seed, so the serialized mesh can be stored
+# under a hash of the normalized parameters: an in-process LRU with a byte budget in front of
+# a directory of files on disk with size-based eviction. The async methods keep the disk tier off the event loop
+import asyncio, hashlib, json, os, threading
+from collections import OrderedDict
+
+# Normalize a parameter set into a stable key, floats are rounded so 0.1 and 0.10000000000000001 match
+def getCacheKey(**params):
+    normalized = {}
+    for name, value in sorted(params.items()):
+        if hasattr(value, 'value'): # Enum values such as MeshType
+            value = value.value
+        if isinstance(value, float):
+            value = round(value, 12)
+        normalized[name] = value
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True).encode('utf-8')).hexdigest()
+
+class MeshCache:
+    def __init__(self, memoryBytes = 64 * 1024 * 1024, diskDir = None, diskBytes = 1024 * 1024 * 1024):
+        self.memoryBytes = memoryBytes
+        self.diskDir = diskDir
+        self.diskBytes = diskBytes
+        self.lock = threading.Lock()
+        self.evictLock = threading.Lock() # Only one disk scan at a time, taken without holding lock
+        self.writing = set() # Keys being written to disk, so concurrent misses write and count them once
+        self.memory = OrderedDict() # key -> bytes, least recently used first
+        self.memoryUsed = 0
+        self.diskUsed = 0
+        self.counters = {'memoryHits': 0, 'diskHits': 0, 'misses': 0, 'memoryEvictions': 0, 'diskEvictions': 0}
+        if diskDir is not None:
+            os.makedirs(diskDir, exist_ok=True)
+            self.diskUsed = sum(os.path.getsize(path) for path in self.getDiskFiles())
+
+    def getDiskFiles(self):
+        return [os.path.join(self.diskDir, name) for name in os.listdir(self.diskDir) if name.endswith('.bin')]
+
+    def getDiskPath(self, key):
+        return os.path.join(self.diskDir, key + '.bin')
+
+    # Get the cached data of a key, or None on a miss. Disk hits are promoted to memory
+    def get(self, key):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.counters['memoryHits'] += 1
+                return data
+        data = self.readDisk(key)
+        with self.lock:
+            if data is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['diskHits'] += 1
+            self.putMemory(key, data)
+        return data
+
+    def put(self, key, data):
+        data = bytes(data)
+        with self.lock:
+            self.putMemory(key, data)
+        self.writeDisk(key, data)
+
+    # get for async callers: memory hits are answered directly, disk reads run in a worker thread
+    async def getAsync(self, key):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.counters['memoryHits'] += 1
+                return data
+            if self.diskDir is None:
+                self.counters['misses'] += 1
+                return None
+        return await asyncio.to_thread(self.get, key)
+
+    # put for async callers: stored in memory right away, written to disk in the background
+    def putAsync(self, key, data):
+        data = bytes(data)
+        with self.lock:
+            self.putMemory(key, data)
+        if self.diskDir is not None:
+            asyncio.get_running_loop().run_in_executor(None, self.writeDisk, key, data)
+
+    # Must be called with the lock held
+    def putMemory(self, key, data):
+        if len(data) > self.memoryBytes:
+            return # Would evict everything else, only keep it on disk
+        if key in self.memory:
+            self.memoryUsed -= len(self.memory.pop(key))
+        self.memory[key] = data
+        self.memoryUsed += len(data)
+        while self.memoryUsed > self.memoryBytes:
+            evictedKey, evictedData = self.memory.popitem(last=False)
+            self.memoryUsed -= len(evictedData)
+            self.counters['memoryEvictions'] += 1
+
+    def readDisk(self, key):
+        if self.diskDir is None:
+            return None
+        path = self.getDiskPath(key)
+        try:
+            with open(path, 'rb') as cacheFile:
+                data = cacheFile.read()
+            os.utime(path) # Mark as recently used for eviction
+            return data
+        except OSError:
+            return None
+
+    def writeDisk(self, key, data):
+        if self.diskDir is None or len(data) > self.diskBytes:
+            return
+        path = self.getDiskPath(key)
+        with self.lock:
+            if key in self.writing:
+                return
+            self.writing.add(key)
+        try:
+            if os.path.exists(path):
+                os.utime(path)
+                return
+            # Write to a temporary file first so readers never see a partial file
+            tempPath = '{}.{}.tmp'.format(path, threading.get_ident())
+            with open(tempPath, 'wb') as cacheFile:
+                cacheFile.write(data)
+            os.replace(tempPath, path)
+        except OSError:
+            return # A full or read-only disk only costs the disk tier
+        finally:
+            with self.lock:
+                self.writing.discard(key)
+        with self.lock:
+            self.diskUsed += len(data)
+            overBudget = self.diskUsed > self.diskBytes
+        if overBudget:
+            self.evictDisk()
+
+    # Remove the least recently used files until the disk tier fits its budget
+    # The directory scan runs without the lock, a scan already running makes this one unnecessary
+    def evictDisk(self):
+        if not self.evictLock.acquire(blocking=False):
+            return
+        try:
+            files = []
+            for path in self.getDiskFiles():
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+            files.sort()
+            diskUsed = sum(size for _, size, _ in files)
+            evictions = 0
+            for _, size, path in files:
+                if diskUsed <= self.diskBytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                diskUsed -= size
+                evictions += 1
+            with self.lock:
+                self.diskUsed = diskUsed
+                self.counters['diskEvictions'] += evictions
+        finally:
+            self.evictLock.release()
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, memoryEntries=len(self.memory), memoryBytes=self.memoryUsed,
+                        diskBytes=self.diskUsed)
@@ -0,0 +1,145 @@
+# Lightweight instrumentation of the generation pipeline
+# measureSpan records the duration of a stage (and the peak traced allocation when tracemalloc runs) into a
+# plain list of dicts, so spans measured in a worker process can be sent back with the result.
+# MetricsRegistry aggregates them into histograms and counters rendered in the Prometheus text format
+import math, threading, time, tracemalloc
+from contextlib import contextmanager
+
+# Upper bounds of the resolution label, resolutions finer than the first bound fall in the first bucket
+RESOLUTION_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 1.0)
+DURATION_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = tuple(1024 * 4 ** power for power in range(11)) # 1 KiB to 1 GiB
+COUNT_BUCKETS = tuple(10 ** power for power in range(1, 8))
+
+def getResolutionBucket(resolution):
+    for bound in RESOLUTION_BUCKETS:
+        if resolution <= bound:
+            return str(bound)
+    return '+Inf'
+
+# Time a block as one span appended to spans, nothing is recorded when spans is None
+# The yielded dict can be extended by the caller (e.g. with the size of the stage result)
+@contextmanager
+def measureSpan(spans, stage):
+    if spans is None:
+        yield {}
+        return
+    span = {'stage': stage}
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        startBytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        span['seconds'] = time.perf_counter() - start
+        if tracing:
+            span['peakBytes'] = max(0, tracemalloc.get_traced_memory()[1] - startBytes)
+        spans.append(span)
+
+def formatLabels(labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"')) for name, value in labels)
+
+def formatValue(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.values = {} # sorted label tuple -> value
+
+    def inc(self, amount = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} counter'.format(self.name)]
+        for key, value in sorted(self.values.items()):
+            lines.append('{}{{{}}} {}'.format(self.name, formatLabels(key), formatValue(value)))
+        return lines
+
+class Histogram:
+    def __init__(self, name, description, buckets):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets) + (math.inf,)
+        self.values = {} # sorted label tuple -> [bucket counts..., sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        state = self.values.get(key)
+        if state is None:
+            state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                state[index] += 1 # Buckets are cumulative
+        state[-2] += value
+        state[-1] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description), '# TYPE {} histogram'.format(self.name)]
+        for key, state in sorted(self.values.items()):
+            for bound, count in zip(self.buckets, state):
+                lines.append('{}_bucket{{{}}} {}'.format(self.name, formatLabels(key + (('le', formatValue(bound)),)), count))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, formatLabels(key), formatValue(state[-2])))
+            lines.append('{}_count{{{}}} {}'.format(self.name, formatLabels(key), state[-1]))
+        return lines
+
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def counter(self, name, description):
+        return self.metrics.setdefault(name, Counter(name, description))
+
+    def histogram(self, name, description, buckets = DURATION_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(name, description, buckets))
+
+    def inc(self, name, amount = 1, **labels):
+        with self.lock:
+            self.metrics[name].inc(amount, **labels)
+
+    def observe(self, name, value, **labels):
+        with self.lock:
+            self.metrics[name].observe(value, **labels)
+
+    # Record the spans and mesh size of one generation job
+    def recordJob(self, job, **labels):
+        with self.lock:
+            for span in job.get('spans', []):
+                stageLabels = dict(labels, stage=span['stage'])
+                self.metrics['ruffle_stage_duration_seconds'].observe(span['seconds'], **stageLabels)
+                if 'resultBytes' in span:
+                    self.metrics['ruffle_stage_result_bytes'].observe(span['resultBytes'], **stageLabels)
+                if 'peakBytes' in span:
+                    self.metrics['ruffle_stage_peak_bytes'].observe(span['peakBytes'], **stageLabels)
+            if 'vertices' in job:
+                self.metrics['ruffle_mesh_vertices'].observe(job['vertices'], **labels)
+                self.metrics['ruffle_mesh_faces'].observe(job['faces'], **labels)
+            if job.get('repaired'):
+                self.metrics['ruffle_mesh_repairs_total'].inc(**labels)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for metric in self.metrics.values():
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+# Registry with the metrics recorded for every generation job
+def createGenerationMetrics():
+    registry = MetricsRegistry()
+    registry.histogram('ruffle_stage_duration_seconds', 'Duration of each generation stage')
+    registry.histogram('ruffle_stage_result_bytes', 'Bytes of the arrays produced by each generation stage', BYTES_BUCKETS)
+    registry.histogram('ruffle_stage_peak_bytes', 'Peak traced allocation of each stage (RUFFLE_TRACE_MEMORY=1 only)', \
+                       BYTES_BUCKETS)
+    registry.histogram('ruffle_mesh_vertices', 'Vertices of the generated meshes', COUNT_BUCKETS)
+    registry.histogram('ruffle_mesh_faces', 'Faces of the generated meshes', COUNT_BUCKETS)
+    registry.counter('ruffle_mesh_repairs_total', 'Meshes that failed validation and went through the trimesh repair')
+    registry.counter('ruffle_generations_total', 'Generation requests by result (generated, cache hit or error)')
+    return registry
@@ -0,0 +1,78 @@
+# Deterministic profiler for single generation jobs
+# Every Python and C call of the profiled thread is timed with its full call stack, which gives both the hot
+# functions (self and cumulative time) and a collapsed-stack file for flamegraph.pl or speedscope.
+# sys.setprofile only affects the calling thread, other requests keep running unprofiled
+import os, sys, time
+from collections import defaultdict
+
+def getFrameName(frame):
+    code = frame.f_code
+    return '{}:{}'.format(os.path.basename(code.co_filename), code.co_name)
+
+def getCFunctionName(function):
+    module = getattr(function, '__module__', None)
+    if module is None and getattr(function, '__self__', None) is not None:
+        module = type(function.__self__).__name__ # Methods of builtin types, e.g. list.append
+    name = getattr(function, '__qualname__', getattr(function, '__name__', repr(function)))
+    return '{}.{}'.format(module, name) if module else name
+
+class StackProfiler:
+    def __init__(self):
+        self.stack = [] # [name, start time, time spent in callees]
+        self.selfTimes = defaultdict(float) # tuple of names from the outermost call -> self time
+        self.callCounts = defaultdict(int)
+
+    def profile(self, frame, event, arg):
+        now = time.perf_counter()
+        if event == 'call' or event == 'c_call':
+            self.stack.append([getFrameName(frame) if event == 'call' else getCFunctionName(arg), now, 0.0])
+        elif self.stack and event in ('return', 'c_return', 'c_exception'):
+            stackKey = tuple(entry[0] for entry in self.stack)
+            name, start, childTime = self.stack.pop()
+            elapsed = now - start
+            self.selfTimes[stackKey] += elapsed - childTime
+            self.callCounts[name] += 1
+            if self.stack:
+                self.stack[-1][2] += elapsed
+
+    def start(self):
+        sys.setprofile(self.profile)
+
+    def stop(self):
+        sys.setprofile(None)
+
+    # Functions sorted by cumulative time, recursive calls are only counted once per stack
+    def getTopFunctions(self, limit = 30):
+        selfTotals = defaultdict(float)
+        cumulativeTotals = defaultdict(float)
+        for stackKey, seconds in self.selfTimes.items():
+            selfTotals[stackKey[-1]] += seconds
+            for name in set(stackKey):
+                cumulativeTotals[name] += seconds
+        functions = [{'function': name, 'calls': self.callCounts[name], 'selfSeconds': selfTotals[name], \
+                      'cumulativeSeconds': cumulativeTotals[name]} for name in cumulativeTotals]
+        functions.sort(key=lambda function: (function['cumulativeSeconds'], function['selfSeconds']), reverse=True)
+        return functions[:limit]
+
+    # One 'outer;inner;leaf microseconds' line per stack, the format read by flamegraph.pl
+    def getCollapsedStacks(self):
+        lines = []
+        for stackKey, seconds in sorted(self.selfTimes.items()):
+            microseconds = int(round(seconds * 1e6))
+            if microseconds > 0:
+                lines.append('{} {}'.format(';'.join(stackKey), microseconds))
+        return '\n'.join(lines) + '\n'
+
+# Run func(*args) under the profiler, returns its result and the profile
+# Top level so it can be sent to a generation worker process
+def profileCall(func, *args, limit = 30):
+    profiler = StackProfiler()
+    start = time.perf_counter()
+    profiler.start()
+    try:
+        result = func(*args)
+    finally:
+        profiler.stop()
+    profile = {'seconds': time.perf_counter() - start, 'top': profiler.getTopFunctions(limit), \
+               'collapsed': profiler.getCollapsedStacks()}
+    return result, profile
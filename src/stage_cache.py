@@ -0,0 +1,66 @@
+# Memoization of the intermediate results of the generation pipeline
+# Every stage (control points, curve evaluation, thickening, lofting) has its own LRU cache keyed only on
+# the inputs of that stage plus the key of the stage before it, so changing a late parameter such as
+# height reuses everything upstream. Cached arrays are made read-only since they are shared between calls
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# Bytes held by a cached value, arrays inside tuples and lists are counted
+def getValueBytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(getValueBytes(item) for item in value)
+    return 64
+
+# Make the arrays of a cached value read-only
+def freezeValue(value):
+    if isinstance(value, np.ndarray):
+        value.setflags(write=False)
+    elif isinstance(value, (tuple, list)):
+        for item in value:
+            freezeValue(item)
+    return value
+
+class StageCache:
+    def __init__(self, maxBytes = 16 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (value, size), least recently used first
+        self.usedBytes = 0
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    # Return the cached value of key, or compute, store and return it
+    def get(self, key, compute):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return entry[0]
+            self.counters['misses'] += 1
+        # Compute outside the lock, two threads missing the same key both compute it
+        value = freezeValue(compute())
+        size = getValueBytes(value)
+        if value is None or size > self.maxBytes:
+            return value
+        with self.lock:
+            if key in self.entries:
+                self.usedBytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.usedBytes += size
+            while self.usedBytes > self.maxBytes:
+                _, (_, evictedSize) = self.entries.popitem(last=False)
+                self.usedBytes -= evictedSize
+                self.counters['evictions'] += 1
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.usedBytes = 0
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counters, entries=len(self.entries), bytes=self.usedBytes)
@@ -1,11 +1,19 @@
 document.addEventListener("DOMContentLoaded", () => {
     const form = document.getElementById("paramsForm");
-    const viewer = document.getElementById("viewer");
+    const viewer = createViewer(document.getElementById("viewer"), document.getElementById("stats"));
+    // Seed of the last mesh shown, live updates keep using it while the seed field is empty
+    let lastSeed = null;
 
     form.addEventListener("submit", async (event) => {
         event.preventDefault();
 
         const params = new URLSearchParams(new FormData(form));
+        // Leave out empty optional fields (e.g. no seed) so the server uses its defaults
+        for (const [key, value] of [...params]) {
+        if (value === "") params.delete(key);
+        }
+        // Show a coarse preview first, then replace it with the full resolution mesh
+        params.set("lod", "coarse");
         const response = await fetch(`/generate-stl?${params.toString()}`);
 
         if (!response.ok) {
@@ -13,23 +21,105 @@ document.addEventListener("DOMContentLoaded", () => {
         return;
         }
 
-        const blob = await response.blob();
-        const url = URL.createObjectURL(blob);
+        // The body is raw binary STL, the seed used comes back in a header
+        const seed = response.headers.get("X-Seed");
+        if (seed !== null) {
+        lastSeed = seed;
+        form.elements["seed"].placeholder = `Last seed: ${seed}`;
+        }
+
+        // Load STL, GLB or compact mesh with Three.js
+        viewer.setGeometry(await parseGeometry(await response.arrayBuffer(), response.headers.get("Content-Type")));
 
-        // Load STL with Three.js
-        loadSTLToViewer(url);
+        const refineUrl = response.headers.get("X-Refine-Url");
+        if (refineUrl !== null) {
+        const refined = await fetch(refineUrl);
+        if (refined.ok) {
+            viewer.setGeometry(await parseGeometry(await refined.arrayBuffer(), refined.headers.get("Content-Type")));
+        }
+        }
     });
 
-    async function loadSTLToViewer(url) {
-        viewer.innerHTML = ""; // Clear previous render
+    // Live tweaking: every form change goes over the WebSocket, the server debounces the updates
+    // and only answers with the mesh of the newest one (a JSON header, then the binary mesh)
+    let socket = null;
+    let pendingHeader = null;
+    function getSocket() {
+        if (socket === null || socket.readyState > WebSocket.OPEN) {
+        socket = new WebSocket(`${location.protocol === "https:" ? "wss" : "ws"}://${location.host}/ws/generate`);
+        socket.binaryType = "arraybuffer";
+        socket.addEventListener("message", async (message) => {
+            if (typeof message.data === "string") {
+            const header = JSON.parse(message.data);
+            if (header.error !== undefined) {
+                console.warn(`Live update failed: ${header.error}`);
+            } else {
+                pendingHeader = header;
+            }
+            return;
+            }
+            if (pendingHeader !== null) {
+            const header = pendingHeader;
+            pendingHeader = null;
+            lastSeed = String(header.seed);
+            form.elements["seed"].placeholder = `Last seed: ${header.seed}`;
+            viewer.setGeometry(await parseGeometry(message.data, header.content_type));
+            }
+        });
+        }
+        return socket;
+    }
+
+    form.addEventListener("input", () => {
+        const params = Object.fromEntries(new FormData(form));
+        for (const key of Object.keys(params)) {
+        if (params[key] === "") delete params[key];
+        }
+        if (params.seed === undefined && lastSeed !== null) {
+        params.seed = lastSeed;
+        }
+        const channel = getSocket();
+        if (channel.readyState === WebSocket.OPEN) {
+        channel.send(JSON.stringify(params));
+        } else {
+        channel.addEventListener("open", () => channel.send(JSON.stringify(params)), { once: true });
+        }
+    });
 
+    // Parse a generated mesh into a BufferGeometry, the time it took is shown in the stats overlay
+    async function parseGeometry(buffer, contentType) {
+        const startTime = performance.now();
+        const geometry = await decodeGeometry(buffer, contentType);
+        viewer.stats.decodeTime = performance.now() - startTime;
+        return geometry;
+    }
+
+    // Decode a generated mesh according to its content type
+    async function decodeGeometry(buffer, contentType) {
+        if (contentType === "application/x-ruffle-mesh") {
+        return decodeCompactMesh(buffer);
+        }
+        if (contentType === "model/gltf-binary") {
+        // Indexed GLB carries positions and indices only, normals are computed here
+        const gltf = await new Promise((resolve, reject) => new THREE.GLTFLoader().parse(buffer, "", resolve, reject));
+        const geometry = gltf.scene.children[0].geometry;
+        geometry.computeVertexNormals();
+        return geometry;
+        }
+        return new THREE.STLLoader().parse(buffer);
+    }
+
+    // One long-lived scene, renderer and controls for the whole session
+    // New meshes are swapped into the same BufferGeometry (reusing its typed arrays when the sizes match)
+    // and frames are only rendered when something changed
+    function createViewer(container, statsElement) {
         const scene = new THREE.Scene();
-        const camera = new THREE.PerspectiveCamera(75, viewer.clientWidth / viewer.clientHeight, 0.1, 1000);
+        const camera = new THREE.PerspectiveCamera(75, container.clientWidth / container.clientHeight, 0.1, 1000);
         camera.position.z = 3;
 
         const renderer = new THREE.WebGLRenderer({ antialias: true });
-        renderer.setSize(viewer.clientWidth, viewer.clientHeight);
-        viewer.appendChild(renderer.domElement);
+        renderer.setSize(container.clientWidth, container.clientHeight);
+        container.appendChild(renderer.domElement);
 
         const controls = new THREE.OrbitControls(camera, renderer.domElement);
 
@@ -37,18 +127,170 @@ document.addEventListener("DOMContentLoaded", () => {
         light.position.set(5, 5, 5).normalize();
         scene.add(light);
 
-        const loader = new THREE.STLLoader();
-        loader.load(url, function (geometry) {
         const material = new THREE.MeshStandardMaterial({ color: 0x0077be, metalness: 0.3, roughness: 0.6 });
-        const mesh = new THREE.Mesh(geometry, material);
+        const mesh = new THREE.Mesh(new THREE.BufferGeometry(), material);
         scene.add(mesh);
-        animate();
-        });
 
-        function animate() {
-        requestAnimationFrame(animate);
+        // decodeTime: parsing the response (set by parseGeometry), copyTime: filling the geometry on the CPU,
+        // uploadTime: the first frame after it, where three.js uploads the new or changed buffers to the GPU
+        const stats = { frameTime: 0, decodeTime: 0, copyTime: 0, uploadTime: 0, reused: false };
+        let renderRequested = false;
+        let uploadPending = false;
+
+        function showStats() {
+        if (statsElement) {
+            statsElement.textContent = `frame ${stats.frameTime.toFixed(2)} ms | decode ${stats.decodeTime.toFixed(2)} ms` +
+            ` | copy ${stats.copyTime.toFixed(2)} ms` +
+            ` | upload ${stats.uploadTime.toFixed(2)} ms | ${stats.reused ? "buffers reused" : "new buffers"}`;
+        }
+        }
+
+        function render() {
+        renderRequested = false;
+        const startTime = performance.now();
         controls.update();
         renderer.render(scene, camera);
+        stats.frameTime = performance.now() - startTime;
+        if (uploadPending) {
+            uploadPending = false;
+            stats.uploadTime = stats.frameTime;
+        }
+        showStats();
         }
+
+        function requestRender() {
+        if (!renderRequested) {
+            renderRequested = true;
+            requestAnimationFrame(render);
+        }
+        }
+
+        controls.addEventListener("change", requestRender);
+        window.addEventListener("resize", () => {
+        camera.aspect = container.clientWidth / container.clientHeight;
+        camera.updateProjectionMatrix();
+        renderer.setSize(container.clientWidth, container.clientHeight);
+        requestRender();
+        });
+
+        // Copy the attributes of a parsed geometry into the displayed one
+        function setGeometry(geometry) {
+        const startTime = performance.now();
+        const current = mesh.geometry;
+        const names = Object.keys(geometry.attributes);
+        const sameLayout = names.length === Object.keys(current.attributes).length &&
+            names.every((name) => current.attributes[name] && current.attributes[name].array.length === geometry.attributes[name].array.length) &&
+            (geometry.index === null) === (current.index === null) &&
+            (geometry.index === null || current.index.array.length === geometry.index.array.length);
+        if (sameLayout && names.length > 0) {
+            // Same vertex count: overwrite the existing typed arrays, three.js re-uploads them in place
+            for (const name of names) {
+            current.attributes[name].array.set(geometry.attributes[name].array);
+            current.attributes[name].needsUpdate = true;
+            }
+            if (geometry.index !== null) {
+            current.index.array.set(geometry.index.array);
+            current.index.needsUpdate = true;
+            }
+            current.computeBoundingSphere();
+            geometry.dispose();
+        } else {
+            // Different size: free the GPU buffers of the old geometry before switching
+            current.dispose();
+            mesh.geometry = geometry;
+        }
+        stats.reused = sameLayout && names.length > 0;
+        stats.copyTime = performance.now() - startTime;
+        uploadPending = true;
+        requestRender();
+        }
+
+        return { setGeometry, requestRender, stats };
+    }
+
+    // Face indices of the loft meshes, must match getFaceTopology in create_mesh.py
+    function getFaceTopology(meshType, n, numRings = 2) {
+        const nn = 2 * n;
+        const top = (numRings - 1) * nn;
+        const closed = meshType === "tube" || meshType === "skirt";
+        const capped = meshType === "curtain" || meshType === "cape";
+        const groups = closed ? n : n - 1;
+        const faces = new Uint32Array((groups * (4 + 4 * (numRings - 1)) + (capped ? 4 * (numRings - 1) : 0)) * 3);
+        let k = 0;
+        const push = (a, b, c) => { faces[k++] = a; faces[k++] = b; faces[k++] = c; };
+        if (capped) {
+        for (let r = 0; r < top; r += nn) {
+            push(r, r + n + nn, r + n);
+            push(r + n + nn, r, r + nn);
+        }
+        }
+        for (let x = 0; x < groups; x++) {
+        const x1 = (x + 1) % n;
+        push(x, x1 + n, x1);
+        push(x, x + n, x1 + n);
+        push(x + top, x1 + top, x1 + n + top);
+        push(x + top, x1 + n + top, x + n + top);
+        for (let r = 0; r < top; r += nn) {
+            push(r + x, r + x1, r + x1 + nn);
+            push(r + x, r + x1 + nn, r + x + nn);
+            push(r + x1 + n, r + x + nn + n, r + x1 + nn + n);
+            push(r + x1 + n, r + x + n, r + x + nn + n);
+        }
+        }
+        if (capped) {
+        for (let r = 0; r < top; r += nn) {
+            push(r + n - 1, r + nn - 1, r + n + nn - 1);
+            push(r + nn - 1, r + nn + nn - 1, r + n + nn - 1);
+        }
+        }
+        return faces;
+    }
+
+    // Decode the compact mesh format written by getCompactBytes in create_mesh.py
+    function decodeCompactMesh(buffer) {
+        const view = new DataView(buffer);
+        const topologies = ["explicit", "curtain", "tube", "cape", "skirt"];
+        const topology = topologies[view.getUint8(4)];
+        const numRings = view.getUint8(5) || 2; // 0 in files written before multi-ring lofts
+        const vertexCount = view.getUint32(8, true);
+        const faceCount = view.getUint32(12, true);
+        const origin = [0, 1, 2].map((i) => view.getFloat32(16 + 4 * i, true));
+        const step = [0, 1, 2].map((i) => view.getFloat32(28 + 4 * i, true));
+        let offset = 40;
+        const quantized = new Uint16Array(buffer.slice(offset, offset + vertexCount * 6));
+        const positions = new Float32Array(vertexCount * 3);
+        for (let i = 0; i < positions.length; i++) {
+        positions[i] = quantized[i] * step[i % 3] + origin[i % 3];
+        }
+        offset += vertexCount * 6;
+
+        let indices;
+        if (topology !== "explicit") {
+        indices = getFaceTopology(topology, vertexCount / (2 * numRings), numRings);
+        } else {
+        // Zigzag encoded index deltas stored as LEB128 varints
+        const bytes = new Uint8Array(buffer, offset + 4, view.getUint32(offset, true));
+        indices = new Uint32Array(faceCount * 3);
+        let position = 0;
+        let previous = 0;
+        for (let i = 0; i < indices.length; i++) {
+            let value = 0;
+            let scale = 1;
+            let byte;
+            do {
+            byte = bytes[position++];
+            value += (byte & 0x7f) * scale;
+            scale *= 128;
+            } while (byte & 0x80);
+            previous += value % 2 === 0 ? value / 2 : -(value + 1) / 2;
+            indices[i] = previous;
+        }
+        }
+
+        const geometry = new THREE.BufferGeometry();
+        geometry.setAttribute("position", new THREE.BufferAttribute(positions, 3));
+        geometry.setIndex(new THREE.BufferAttribute(indices, 1));
+        geometry.computeVertexNormals();
+        return geometry;
     }
-});
\ No newline at end of file
+});